@@ -1,23 +1,95 @@
-import jsonlines
 import os
+import re
+import json
 import argparse
-import tempfile
-import subprocess
+import importlib.metadata
+import heapq
+import multiprocessing
+import threading
+import time
+from array import array
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from collections.abc import Mapping
+from itertools import islice
+from functools import cached_property, lru_cache, partial
 from typing import List, Tuple
 
 import tree_sitter_glsl as tsglsl
 from tqdm.auto import tqdm
-from tree_sitter import Language, Parser
+from tree_sitter import Language, Parser, Query, QueryCursor, Tree
 from licensedcode.detection import detect_licenses
 
 from wgpu_shadertoy.api import shader_args_from_json, _download_media_channels
-from wgpu_shadertoy import BufferRenderPass, Shadertoy
+from wgpu_shadertoy import BufferRenderPass
 
+from cache import CACHE_DIR, MISSING, SqliteCache, hash_key
 from download import read_ids
+from sandbox import DEFAULT_BACKEND, SandboxPool, get_pool
+from storage import SHARD_FORMATS, is_shard, iter_shard, load_id_index, record_id, remove_shard, replace_shard, set_shard_ids, shard_name, shard_stem
 
 GLSL_LANGUAGE = Language(tsglsl.language())
 PARSER = Parser(GLSL_LANGUAGE)
+_parser_lock = threading.Lock()  # the parser is shared, run_shader is also called from threads (filter_needed)
+PARSE_CACHE_SIZE = 256
+# built-in functions of GLSL ES 3.00 (the dialect of Shadertoy), these are parsed as plain identifiers
+GLSL_BUILTIN_FUNCTIONS = frozenset([
+    "radians", "degrees", "sin", "cos", "tan", "asin", "acos", "atan", "sinh", "cosh", "tanh", "asinh", "acosh", "atanh",
+    "pow", "exp", "log", "exp2", "log2", "sqrt", "inversesqrt",
+    "abs", "sign", "floor", "trunc", "round", "roundEven", "ceil", "fract", "mod", "modf", "min", "max", "clamp", "mix", "step", "smoothstep",
+    "isnan", "isinf", "floatBitsToInt", "floatBitsToUint", "intBitsToFloat", "uintBitsToFloat",
+    "packSnorm2x16", "unpackSnorm2x16", "packUnorm2x16", "unpackUnorm2x16", "packHalf2x16", "unpackHalf2x16",
+    "length", "distance", "dot", "cross", "normalize", "faceforward", "reflect", "refract",
+    "matrixCompMult", "outerProduct", "transpose", "determinant", "inverse",
+    "lessThan", "lessThanEqual", "greaterThan", "greaterThanEqual", "equal", "notEqual", "any", "all", "not",
+    "textureSize", "texture", "textureProj", "textureLod", "textureOffset", "texelFetch", "texelFetchOffset", "textureProjOffset",
+    "textureLodOffset", "textureProjLod", "textureProjLodOffset", "textureGrad", "textureGradOffset", "textureProjGrad", "textureProjGradOffset",
+    "dFdx", "dFdy", "fwidth",
+])
+# types, used as constructors they are parsed as identifiers too
+GLSL_BUILTIN_TYPES = frozenset(
+    ["void", "bool", "int", "uint", "float", "double"]
+    + [f"{prefix}vec{n}" for prefix in ("", "b", "i", "u", "d") for n in (2, 3, 4)]
+    + [f"{prefix}mat{n}" for prefix in ("", "d") for n in (2, 3, 4)]
+    + [f"{prefix}mat{n}x{m}" for prefix in ("", "d") for n in (2, 3, 4) for m in (2, 3, 4)]
+    + [f"{prefix}sampler{kind}" for prefix in ("", "i", "u") for kind in ("2D", "3D", "Cube", "2DArray")]
+    + ["sampler2DShadow", "samplerCubeShadow", "sampler2DArrayShadow"]
+)
+# inputs Shadertoy declares for every pass
+SHADERTOY_UNIFORMS = frozenset([
+    "iResolution", "iTime", "iTimeDelta", "iFrameRate", "iFrame", "iChannelTime", "iChannelResolution", "iMouse", "iDate", "iSampleRate",
+    "iChannel0", "iChannel1", "iChannel2", "iChannel3", "iGlobalTime",
+])
+# anything else the renderer might provide, names that aren't declared are only reported if they aren't one of these
+GLSL_EXTRA_NAMES = frozenset([
+    # GLSL ES 1.00
+    "texture2D", "texture2DLod", "texture2DProj", "texture2DProjLod", "textureCube", "textureCubeLod", "texture2DGradEXT", "texture2DLodEXT", "textureCubeLodEXT",
+    # desktop GLSL 4.x
+    "fma", "frexp", "ldexp", "packUnorm4x8", "packSnorm4x8", "unpackUnorm4x8", "unpackSnorm4x8", "packDouble2x32", "unpackDouble2x32",
+    "uaddCarry", "usubBorrow", "umulExtended", "imulExtended", "bitfieldExtract", "bitfieldInsert", "bitfieldReverse", "bitCount", "findLSB", "findMSB",
+    "textureGather", "textureGatherOffset", "textureGatherOffsets", "textureQueryLod", "textureQueryLevels", "texelFetch", "textureSamples",
+    "dFdxFine", "dFdyFine", "dFdxCoarse", "dFdyCoarse", "fwidthFine", "fwidthCoarse", "interpolateAtCentroid", "interpolateAtSample", "interpolateAtOffset",
+    "imageLoad", "imageStore", "imageSize", "barrier", "memoryBarrier", "atomicAdd",
+    # keywords, the grammar sometimes takes them for identifiers. And the macro Shadertoy defines
+    "discard", "precision", "lowp", "mediump", "highp", "invariant", "const", "in", "out", "inout", "uniform", "struct",
+    "if", "else", "for", "while", "do", "switch", "case", "default", "return", "break", "continue", "true", "false", "HW_PERFORMANCE",
+])
+# words that can come before a use, any other word (or "]") before a name might be its type
+_USE_PREFIXES = frozenset(["return", "else", "case", "do", "in", "out", "inout", "const"])
+BASE_LICENSE = "CC-BY-NC-SA-3.0"  # base case is capitalized for downstream analysis
+# set to None to disable the license cache
+LICENSE_CACHE_PATH = os.path.join(CACHE_DIR, "licenses.sqlite")
+LICENSE_CACHE_SIZE = 200_000
+_license_cache = None  # opened lazily, once per process
+TEST_WORKERS = 1  # size of the sandbox pool used by run_shader
+ASYNC_COLUMNS = {"test"}  # with more than one test worker these run in threads, so all the sandboxes of the pool get work
+_test_executor = None
+# set to None to disable the test result cache
+TEST_CACHE_PATH = os.path.join(CACHE_DIR, "tests.sqlite")
+TEST_CACHE_SIZE = 1_000_000
+_test_cache = None
+PROFILE = False  # record the time every column takes, see AnnotationProfile
+PROFILE_PATH = "./data/annotate_profile.json"
 
 
 argument_parser = argparse.ArgumentParser()
@@ -26,13 +98,24 @@ argument_parser.add_argument("--output", type=str, required=False, default="./da
 argument_parser.add_argument("--mode", type=str, default="update", help="mode `update` will load shaders already in the output folder and overwrite specified columns; mode `redo` will overwrite the whole file")
 argument_parser.add_argument("--columns", type=str, required=True, help="comma separated list of columns to annotate: all, license, functions, test; if empty will simply faltten the nested structure") 
 argument_parser.add_argument("--ids", type=str, required=False, default="", help="command seperated list or path to a .txt file of ids to update. Will do all in the output dir if left empty")
+argument_parser.add_argument("--license_cache", type=str, required=False, default=LICENSE_CACHE_PATH, help="sqlite file to cache license detections by comment header, set to empty string to disable")
+argument_parser.add_argument("--workers", type=int, required=False, default=1, help="number of worker processes, each loads the parser and license index once at startup")
+argument_parser.add_argument("--test_workers", type=int, required=False, default=TEST_WORKERS, help="number of sandboxed renderer processes per worker, the test column runs on all of them at once")
+argument_parser.add_argument("--test_cache", type=str, required=False, default=TEST_CACHE_PATH, help="sqlite file to cache test results by code, set to empty string to disable")
+argument_parser.add_argument("--chunk_size", type=int, required=False, default=16, help="number of records sent to a worker at once")
+argument_parser.add_argument("--buffer_size", type=int, required=False, default=1024, help="maximum number of records held in memory per file while updating")
+argument_parser.add_argument("--force", action="store_true", help="in `redo` mode recompute all columns, even those that are up to date in the existing output")
+argument_parser.add_argument("--profile", type=str, nargs="?", const=PROFILE_PATH, default=None, help=f"time every column per shader and write a report to this json file (default {PROFILE_PATH})")
+argument_parser.add_argument("--format", type=str, required=False, default=None, choices=["jsonl", "zst", "parquet"], help="storage format of the output shards in `redo` mode, keeps the format of the input if not set")
 # TODO: is --mode "update" --columns "all" is the same as --mode "redo"?
 
 
-def annotate_shader(shader_data: dict, columns: list, access: str = "api") -> dict:
+def annotate_shader(shader_data: dict, columns: list, access: str = "api", previous: dict = None, resolve: bool = True) -> dict:
     """
     Functions calls a bunch of smaller functions to annotate and flatten a instance of a shader_data json respose
     Returns a flattened dict that is a dataset insanace
+    If the `previous` annotation of this shader is given, columns that are still up to date (see `is_current`) are copied from it instead.
+    `resolve` is passed on to update_shader.
     """
     if "Shader" in shader_data:
         shader_data = shader_data["Shader"]
@@ -41,24 +124,125 @@ def annotate_shader(shader_data: dict, columns: list, access: str = "api") -> di
         f"https://www.shadertoy.com/media/shaders/{shader_data['info']['id']}.jpg"
     )
     out_dict["access"] = access  # api, shaders20k, ?
+    out_dict["fingerprint"] = shader_fingerprint(out_dict)
+    out_dict["stamps"] = {}
+
+    cols_to_update = expand_columns(columns)
+    if previous is not None and previous.get("fingerprint") == out_dict["fingerprint"]:
+        for col in [col for col in cols_to_update if is_current(previous, col)]:
+            out_dict[col] = previous[col]
+            out_dict["stamps"][col] = previous["stamps"][col]
+            cols_to_update.remove(col)
 
     # overwrite to update?
-    out_dict = update_shader(out_dict, columns=columns)
+    out_dict = update_shader(out_dict, columns=cols_to_update, resolve=resolve)
 
     return out_dict
 
-def update_shader(flattened_shader: dict, columns: list) -> dict:
+def annotate_with_previous(shader_and_previous: tuple, columns: list, access: str = "api") -> dict:
+    # map_records hands over a single argument and resolves the tests per chunk (see apply_chunk)
+    shader_data, previous = shader_and_previous
+    return annotate_shader(shader_data, columns=columns, access=access, previous=previous, resolve=False)
+
+def update_shader(flattened_shader: dict, columns: list, resolve: bool = True) -> dict:
+    """
+    (re)computes the given columns of a flattened shader.
+    With more than one test worker the test column is started in the background, with `resolve=False` it's left as a Future
+    for resolve_columns, so the caller can start the tests of other records first (like apply_chunk does).
+    """
     updated_shader = flattened_shader.copy() # do we need that?
     
-    cols_to_update = columns.copy() #seems redundant
-    if "all" in columns:
-        cols_to_update = list(COLUMN_MAP.keys())
+    cols_to_update = expand_columns(columns)
+    # all annotators share one context, so the code is only encoded and parsed once
+    context = ParseContext(flattened_shader)
+    stamps = dict(flattened_shader.get("stamps") or {})
+    timings = {}
+    if PROFILE and cols_to_update:
+        start = time.perf_counter()
+        context.tree  # parse up front, otherwise the first column pays for it
+        timings["parse"] = time.perf_counter() - start
     for col in cols_to_update:
         col_func = COLUMN_MAP[col]
-        updated_shader.update({col: col_func(flattened_shader)})
+        if col in ASYNC_COLUMNS and TEST_WORKERS > 1:
+            # resolved by resolve_columns, after the other records of the chunk got their test started too
+            updated_shader[col] = get_test_executor().submit(timed, col_func, context)
+        else:
+            updated_shader[col], timings[col] = timed(col_func, context)
+        stamps[col] = column_stamp(col)
+    if PROFILE:
+        updated_shader["_timings"] = timings  # taken out again by AnnotationProfile.collect before writing
     # TODO: set None for cols not mentioned?
+    if cols_to_update or "fingerprint" not in updated_shader:
+        updated_shader["fingerprint"] = shader_fingerprint(flattened_shader)
+        updated_shader["stamps"] = stamps
+
+    return resolve_columns(updated_shader) if resolve else updated_shader
+
+
+def timed(func, *args) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def get_test_executor() -> ThreadPoolExecutor:
+    """
+    threads that wait for the sandbox pool, one per test worker. Created once per process.
+    """
+    global _test_executor
+    if _test_executor is None or _test_executor._max_workers != TEST_WORKERS:
+        _test_executor = ThreadPoolExecutor(max_workers=TEST_WORKERS, thread_name_prefix="test")
+    return _test_executor
+
+
+def resolve_columns(annotation: dict) -> dict:
+    """
+    waits for the columns update_shader started in the background and fills in their results (and timings)
+    """
+    for col in ASYNC_COLUMNS:
+        if isinstance(annotation.get(col), Future):
+            annotation[col], seconds = annotation[col].result()
+            if "_timings" in annotation:
+                annotation["_timings"][col] = seconds
+    return annotation
 
-    return updated_shader
+
+def expand_columns(columns: list) -> list:
+    if "all" in columns:
+        return list(COLUMN_MAP.keys())
+    return [col for col in columns if col] # an empty --columns only flattens
+
+
+def shader_fingerprint(flattened_shader: dict) -> str:
+    """
+    content hash of everything the annotators look at: the code and inputs of all passes.
+    """
+    fields = sorted(key for key in flattened_shader if key.endswith(("_code", "_inputs")))
+    return hash_key(*[json.dumps(flattened_shader[key], sort_keys=True) for key in fields])
+
+
+@lru_cache(maxsize=None)
+def column_stamp(col: str) -> str:
+    """
+    version of the annotator for a column, together with the versions of the tools it relies on.
+    The test column also names the renderer backend, results of the stand-in renderer never count as current for a real one.
+    """
+    parts = [COLUMN_VERSIONS[col]] + [f"{dependency}=={package_version(dependency)}" for dependency in COLUMN_DEPENDENCIES.get(col, [])]
+    if col == "test":
+        parts.append(f"backend={DEFAULT_BACKEND}")
+    return "+".join(parts)
+
+
+def is_current(annotation: dict, col: str) -> bool:
+    """
+    True if the column of an annotation was computed by the current version of its annotator.
+    Doesn't check the fingerprint, compare that first.
+    """
+    if col not in annotation or (annotation.get("stamps") or {}).get(col) != column_stamp(col):
+        return False
+    if col == "test" and annotation[col] == "timeout":
+        return False  # depends on load, so always worth another try (same as the test cache)
+    return True
 
 
 def flatten_shader_data(shader_data: dict) -> dict:
@@ -77,7 +261,7 @@ def flatten_shader_data(shader_data: dict) -> dict:
     out_dict["tags"] = shader_data["info"]["tags"]
     out_dict["likes"] = shader_data["info"]["likes"]
     out_dict["viewed"] = shader_data["info"]["viewed"]
-    out_dict["published"] = shader_data["info"]["published"] # download uses {0: "Private", 1: "Public", 2: "Unlisted", 3: "Public API", 4: "Anonymous"}
+    out_dict["published"] = shader_data["info"]["published"] # download uses storage.PUBLISHED_NAMES, parquet shards store the names
     out_dict["date"] = shader_data["info"]["date"] # maybe format into a readable format or at least int?
     # this one is added by us wiht the download.py script
     out_dict["time_retrieved"] = shader_data["time_retrieved"]
@@ -117,34 +301,99 @@ def flatten_shader_data(shader_data: dict) -> dict:
     return out_dict
 
 
-def check_license(code_or_shader) -> str:
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_code(code_bytes: bytes) -> Tree:
     """
-    Returns the license mentioned if the first node is a comment.
-    if none is found, or no comment, returns "CC-BY-NC-SA-3.0" as the base case.
+    cached parse, keyed by the (hash of the) code. So identical code is only parsed once, even across records (forks).
+    the returned tree is shared, copy it before editing!
     """
-    if isinstance(code_or_shader, dict):
-        code = code_or_shader["image_code"]
-    elif isinstance(code_or_shader, str):
-        code = code_or_shader
+    with _parser_lock:
+        return PARSER.parse(code_bytes)
+
+
+class ParseContext:
+    """
+    Per record context handed to all annotators. The image code is encoded and parsed lazily, on first access, and then reused.
+    Can be created from a flattened shader or just a string of code.
+    """
+    def __init__(self, code_or_shader):
+        if isinstance(code_or_shader, Mapping):
+            self.shader = code_or_shader
+            self.code = code_or_shader["image_code"]
+        elif isinstance(code_or_shader, str):
+            self.shader = None
+            self.code = code_or_shader
+        else:
+            raise TypeError(f" function doesn't support {type(code_or_shader)}")
+
+    @cached_property
+    def code_bytes(self) -> bytes:
+        return bytes(self.code, encoding="utf-8")
+
+    @cached_property
+    def tree(self) -> Tree:
+        return parse_code(self.code_bytes)
+
+
+def get_context(code_or_shader) -> ParseContext:
+    if isinstance(code_or_shader, ParseContext):
+        return code_or_shader
+    return ParseContext(code_or_shader)
+
+
+def get_license_cache() -> SqliteCache:
+    """
+    the on disk cache from normalized comment header to license, invalidated by a new scancode version
+    """
+    global _license_cache
+    if _license_cache is None and LICENSE_CACHE_PATH:
+        _license_cache = SqliteCache(
+            LICENSE_CACHE_PATH,
+            version=f"scancode-toolkit=={importlib.metadata.version('scancode-toolkit')}",
+            max_entries=LICENSE_CACHE_SIZE,
+        )
+    return _license_cache
+
+
+def detect_license(comment: str) -> str:
+    """
+    Runs scancode license detection on a comment block and returns the first license expression.
+    Results are cached by the comment with normalized whitespace, as many shaders share the same header.
+    """
+    cache = get_license_cache()
+    if cache is not None:
+        key = hash_key(" ".join(comment.split()))
+        cached = cache.get(key)
+        if cached is not MISSING:
+            return cached
+    detections = [x.matches[0] for x in detect_licenses(query_string=comment)]
+    if len(detections) >= 1:
+        license_expression = detections[0].to_dict().get("license_expression", None)
     else:
-        raise TypeError(f" function doesn't support {type(code_or_shader)}")
+        license_expression = BASE_LICENSE
+    if cache is not None:
+        cache.set(key, license_expression)
+    return license_expression
 
 
-    tree = PARSER.parse(bytes(code, encoding="utf-8"))
+def check_license(code_or_shader) -> str:
+    """
+    Returns the license mentioned if the first node is a comment.
+    if none is found, or no comment, returns "CC-BY-NC-SA-3.0" as the base case.
+    """
+    tree = get_context(code_or_shader).tree
     comment_bytes = b""
     cursor = tree.walk()
     cursor.goto_first_child()
     # is a while node really a good idea?
     while cursor.node.type == "comment":
         comment_bytes += cursor.node.text
-        cursor.goto_next_sibling()
+        if not cursor.goto_next_sibling():
+            break  # the code is just comments, otherwise we would loop forever
     if comment_bytes:
-        detections = [x.matches[0] for x in detect_licenses(query_string=comment_bytes.decode(encoding="utf-8"))]
-        if len(detections) >= 1:
-            return detections[0].to_dict().get("license_expression", None)
-    
-    # base case is capitalized for downstream analysis
-    return "CC-BY-NC-SA-3.0"
+        return detect_license(comment_bytes.decode(encoding="utf-8"))
+
+    return BASE_LICENSE
 
 
 def parse_functions(code_or_shader) -> List[Tuple[int,int,int,int,int]]:
@@ -153,15 +402,10 @@ def parse_functions(code_or_shader) -> List[Tuple[int,int,int,int,int]]:
     returns the **byte-indecies** for before_comment, start header, end header, end docstring, end_function.
     returns a list 5-tupel. If before_comment or docstring aren't found, the indiecies will coinside with the next one.
     """
-    # TODO: dry and maybe have it code_or_tree?
-    if isinstance(code_or_shader, dict):
-        code = code_or_shader["image_code"]
-    elif isinstance(code_or_shader, str):
-        code = code_or_shader
-    else:
-        raise TypeError(f" function doesn't support {type(code_or_shader)}")
+    return _functions_from_tree(get_context(code_or_shader).tree)
+
 
-    tree = PARSER.parse(bytes(code, encoding="utf-8"))
+def _functions_from_tree(tree: Tree) -> List[Tuple[int,int,int,int,int]]:
     root_node = tree.root_node
     funcs = []
     
@@ -194,16 +438,183 @@ def parse_functions(code_or_shader) -> List[Tuple[int,int,int,int,int]]:
     return funcs
 
 
-def run_shader(shader_or_code, timeouts=10):
+def _point(code_bytes: bytes, byte_offset: int) -> Tuple[int, int]:
+    # tree-sitter wants (row, column in bytes) next to the byte offsets
+    row = code_bytes.count(b"\n", 0, byte_offset)
+    return (row, byte_offset - (code_bytes.rfind(b"\n", 0, byte_offset) + 1))
+
+
+def edit_code(code_bytes: bytes, tree: Tree, start_byte: int, end_byte: int, new_bytes: bytes) -> Tuple[bytes, Tree]:
+    """
+    replaces code_bytes[start_byte:end_byte] with new_bytes and reparses incrementally, reusing the unchanged parts of `tree`.
+    `tree` itself isn't modified (it might be shared through the parse cache), the edit is done on a copy.
+    """
+    new_code_bytes = code_bytes[:start_byte] + new_bytes + code_bytes[end_byte:]
+    new_end_byte = start_byte + len(new_bytes)
+    edited_tree = tree.copy()
+    edited_tree.edit(
+        start_byte=start_byte,
+        old_end_byte=end_byte,
+        new_end_byte=new_end_byte,
+        start_point=_point(code_bytes, start_byte),
+        old_end_point=_point(code_bytes, end_byte),
+        new_end_point=_point(new_code_bytes, new_end_byte),
+    )
+    with _parser_lock:
+        return new_code_bytes, PARSER.parse(new_code_bytes, edited_tree)
+
+
+def remove_function(code_or_shader, func_bytes, replacement: str = "\n") -> Tuple[str, List[Tuple[int,int,int,int,int]]]:
+    """
+    cuts out the function at `func_bytes` (one entry of the functions column), including the comment before it.
+    Returns the new code and the byte-indices of its functions, without parsing the whole code again.
+    """
+    context = get_context(code_or_shader)
+    start_comment, start_header, end_header, end_docstring, end_function = func_bytes
+    new_code_bytes, new_tree = edit_code(context.code_bytes, context.tree, start_comment, end_function, bytes(replacement, encoding="utf-8"))
+    return new_code_bytes.decode(encoding="utf-8"), _functions_from_tree(new_tree)
+
+
+def replace_body(code_or_shader, func_bytes, body: str) -> Tuple[str, List[Tuple[int,int,int,int,int]]]:
+    """
+    replaces everything after the docstring of the function at `func_bytes` with `body`, e.g. a generated one.
+    `body` should include the closing "}". Returns the new code and the byte-indices of its functions.
+    """
+    context = get_context(code_or_shader)
+    start_comment, start_header, end_header, end_docstring, end_function = func_bytes
+    new_code_bytes, new_tree = edit_code(context.code_bytes, context.tree, end_docstring, end_function, bytes(body, encoding="utf-8"))
+    return new_code_bytes.decode(encoding="utf-8"), _functions_from_tree(new_tree)
+
+
+def package_version(name: str) -> str:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return "missing"
+
+
+def get_test_cache() -> SqliteCache:
+    """
+    on disk cache of test results, invalidated when wgpu or wgpu-shadertoy change
+    """
+    global _test_cache
+    if _test_cache is None and TEST_CACHE_PATH:
+        _test_cache = SqliteCache(
+            TEST_CACHE_PATH,
+            version=f"wgpu=={package_version('wgpu')};wgpu-shadertoy=={package_version('wgpu-shadertoy')}",
+            max_entries=TEST_CACHE_SIZE,
+        )
+    return _test_cache
+
+
+_NAMES_QUERY = Query(GLSL_LANGUAGE, """
+(_ declarator: (identifier) @declared)
+(_ name: (identifier) @declared)
+(preproc_params (identifier) @declared)
+(preproc_function_def name: (identifier) @macro)
+(identifier) @identifier
+(type_identifier) @type
+(preproc_arg) @words
+(ERROR) @words
+(call_expression function: (identifier) arguments: (argument_list) @arguments)
+(preproc_if) @conditional
+(preproc_ifdef) @conditional
+""")
+
+
+def collect_names(tree: Tree) -> Tuple[set, set]:
+    """
+    returns the declared names (functions, variables, parameters, structs, macros) and the used identifiers of a parsed program.
+    Scopes are ignored, a name declared anywhere counts as declared everywhere. Words in macro bodies, in arguments of macros
+    and in parts that didn't parse count as declared, since declarations can hide in there. Uses inside #if blocks don't count,
+    they might not be compiled. So a use is only missed, never reported wrongly.
+    """
+    def text(node) -> str:
+        return node.text.decode("utf-8", errors="replace").strip()
+
+    captures = QueryCursor(_NAMES_QUERY).captures(tree.root_node)
+    declared = {text(node) for node in captures.get("declared", []) + captures.get("type", [])}
+    macros = {text(node) for node in captures.get("macro", [])}
+    for node in captures.get("words", []):
+        declared.update(re.findall(r"[A-Za-z_]\w*", text(node)))
+    for node in captures.get("arguments", []):
+        if text(node.prev_sibling) in macros:
+            declared.update(re.findall(r"[A-Za-z_]\w*", text(node)))
+    declarations = {node.start_byte for node in captures.get("declared", [])}
+    conditional = [(node.start_byte, node.end_byte) for node in captures.get("conditional", [])]
+    used = set()
+    for node in captures.get("identifier", []):
+        if node.is_missing or node.start_byte in declarations:  # missing ones are inserted by the parser to recover from an error
+            continue
+        if any(start <= node.start_byte < end for start, end in conditional):
+            continue
+        used.add(text(node))
+    return declared, used
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def code_names(code_bytes: bytes) -> Tuple[frozenset, frozenset]:
+    """
+    collect_names of the cached parse. Identical code (forks, a common pass shared by many shaders) is only looked at once.
+    """
+    declared, used = collect_names(parse_code(code_bytes))
+    return frozenset(declared), frozenset(used)
+
+
+def static_check(code: str, common: str = "") -> str:
+    """
+    Checks the image code (with the common code of the shader) without rendering it. Returns "error" if it can't compile:
+    there is no mainImage, or it uses a name that is declared nowhere and isn't a builtin or Shadertoy uniform.
+    Returns None in all other cases, that doesn't mean the shader works.
+    Parse errors alone aren't conclusive, the grammar doesn't know all of GLSL (e.g. array constructors).
+    The parse comes from parse_code, so the code isn't parsed again after the other columns did.
+    """
+    if "mainImage" not in code and "mainImage" not in common:
+        return "error"
+    if "##" in code or "##" in common:
+        return None  # token pasting, names can be made up by macros
+    declared = set()
+    used = set()
+    for source in (code, common):
+        if source:
+            source_declared, source_used = code_names(bytes(source, encoding="utf-8"))
+            declared |= source_declared
+            used |= source_used
+    known = declared | GLSL_BUILTIN_FUNCTIONS | GLSL_BUILTIN_TYPES | SHADERTOY_UNIFORMS | GLSL_EXTRA_NAMES
+    # gl_ builtins and predefined macros like __VERSION__
+    undeclared = [name for name in used if name not in known and not name.startswith(("gl_", "GL_", "__"))]
+    if not undeclared:
+        return None
+    # the grammar misses some declarations (e.g. "vec3[2] points = ..."), look for the name after something that could be its type
+    text = re.sub(r"//[^\n]*|/\*.*?\*/", " ", code + "\n" + common, flags=re.DOTALL)
+    for name in undeclared:
+        prefixes = re.findall(r"(\w+|\])\s+" + re.escape(name) + r"\b", text)
+        if not any(prefix not in _USE_PREFIXES for prefix in prefixes):
+            return "error"
+    return None
+
+
+def normalize_code(code: str) -> str:
+    """
+    line endings and trailing whitespace don't change what a shader does
+    """
+    return "\n".join(line.rstrip() for line in code.splitlines()).strip()
+
+
+def run_shader(shader_or_code, timeouts=10, pool: SandboxPool = None):
     """
     Tests a shader by running it in wgpu-shadertoy. Returns one of the following disjunct classes:
     "ok" - shader ran without error
     "incomplete" - not yet fully supported in wgpu-shadertoy
     "error" - wgpu-shadertoy threw and error (is likely still valid on the website)
-    "timedout" - if after 5 seconds we don't get to error or okay.
-    # not implemented: "panic" - worst case scenario. a rust panic in wgpu. This can cause the python process to terminate without recovery.
+    "timeout" - if after `timeouts` seconds we don't get to error or okay.
+    "panic" - worst case scenario. a rust panic in wgpu, which takes down the sandbox worker (it gets replaced).
+    The shader is run in a long lived sandbox worker, from `pool` or the shared pool of this process. Code that fails `static_check` isn't rendered, the check runs after the cache lookup.
+    Results are cached by the normalized code, timeout and renderer backend. Timeouts depend on load and are never cached.
     """
     # return "untested" #placeholder to avoid empty columns for later analysis
+    if isinstance(shader_or_code, ParseContext):
+        shader_or_code = shader_or_code.code if shader_or_code.shader is None else shader_or_code.shader
     if isinstance(shader_or_code, str):
         # case 1 we only get the only a string of code
         shader_args = {"shader_code": shader_or_code}
@@ -237,68 +648,187 @@ def run_shader(shader_or_code, timeouts=10):
         
     shader_args["shader_type"] = "glsl"
 
-    
-    sub_run = run_shader_in_subprocess(shader_args["shader_code"], timeout=timeouts)
-    return sub_run # this later part seems redundant right now. should speed things up a bit...
-    if sub_run == "ok":
-        try:
-            shader = Shadertoy(**shader_args, offscreen=True)
-            if not shader.complete:
-                return "incomplete"
-            else:
-                return "ok"
-        except Exception as e:
-            return "error" # other errors have a .message like wgpu ones.
-    
+    cache = get_test_cache()
+    if cache is not None:
+        # the backend of the shared pool is known without starting it, cache hits shouldn't spawn renderers
+        backend = DEFAULT_BACKEND if pool is None else pool.backend
+        key = hash_key(normalize_code(shader_args["shader_code"]), str(timeouts), backend)
+        cached = cache.get(key)
+        if cached is not MISSING:
+            return cached
+    # code that certainly doesn't compile never reaches a renderer
+    if static_check(shader_args["shader_code"], shader_args.get("common") or "") == "error":
+        sub_run = "error"
+    else:
+        if pool is None:
+            pool = get_pool(TEST_WORKERS)
+        sub_run = pool.run(shader_args["shader_code"], timeout=timeouts)
+    if cache is not None and sub_run != "timeout":
+        cache.set(key, sub_run)
     return sub_run
 
-# this is minimal code to try a single pass shader in a subprocess (no inputs)
-# dual snapshot is required since first one doesn't crash it seems.
-file_template = """
-from wgpu_shadertoy import Shadertoy
 
-shader_code = '''{}'''
+# gloablly map all columns to the function that calculate them. might need to REGISTER more?
+COLUMN_MAP = {"license": check_license, "functions": parse_functions, "test": run_shader}
+# bump the version when changing how a column is computed, so `redo` recomputes it for every shader
+COLUMN_VERSIONS = {"license": "1", "functions": "1", "test": "1"}
+# results also change when these packages are updated
+COLUMN_DEPENDENCIES = {"license": ["scancode-toolkit"], "functions": ["tree-sitter-glsl"], "test": ["wgpu", "wgpu-shadertoy"]}
 
-shader = Shadertoy(shader_code, shader_type="glsl", offscreen=True)
 
-if __name__ == "__main__":
-    snap1 = shader.snapshot(12.34)
-    snap2 = shader.snapshot(56.78)
-    # shader.show()
-"""
-
-# same implementation in the metric, check for inconsistencies (and newer commits): 
-# https://huggingface.co/spaces/Vipitis/shadermatch/blob/c569c78182dc618b36b0883b7d66621481ca2933/shadermatch.py#L302
-# the root cause for this is that some shadercode causes rust panics, which crash the python process too... there is no good solution: https://github.com/pygfx/wgpu-py/pull/603
-def run_shader_in_subprocess(shader_code, timeout=10):
-    """be ver careful with this function, it runs user submitted code, and it can easily be escaped and exploited!"""
-
-
-    status = "ok" # default case
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as f:
-        f.write(file_template.format(shader_code))
-        f.flush()
-        try:
-            p = subprocess.run(["python", f.name], capture_output=True, timeout=timeout) # this might not work as expect on Linux ...
-            
-        except subprocess.SubprocessError as e:
-            if isinstance(e, subprocess.TimeoutExpired):
-                status = "timeout"
-            else:
-                status = "error"
-    
-    # cleanup temp file, delete_on_close was only added in Python 3.12?
-    os.remove(f.name)
-        
-    if status == "ok":
-        if p.returncode != 0:
-            status = "error"
-    
-    return status
+def init_worker(license_cache_path, test_workers=1, test_cache_path=None, profile=False) -> None:
+    """
+    runs once in every worker process, so the expensive setup isn't paid per record
+    """
+    global LICENSE_CACHE_PATH, _license_cache, TEST_WORKERS, TEST_CACHE_PATH, _test_cache, PROFILE
+    PROFILE = profile
+    LICENSE_CACHE_PATH = license_cache_path
+    TEST_WORKERS = test_workers
+    TEST_CACHE_PATH = test_cache_path
+    _test_cache = None
+    _license_cache = None  # sqlite connections can't be shared with the parent
+    PARSER.parse(b"void mainImage(out vec4 fragColor, in vec2 fragCoord){}")
+    # loading the license index takes a few seconds, do it now instead of on the first detection
+    from licensedcode.cache import get_index
+    get_index()
+
+
+def load_previous(path, columns: list) -> dict:
+    """
+    id -> the fingerprint, stamps and given columns of every annotation in a shard, without the (large) code fields.
+    """
+    previous = {}
+    for annotation in iter_shard(path):
+        if "fingerprint" in annotation:
+            keep = ["fingerprint", "stamps"] + [col for col in columns if col in annotation]
+            previous[annotation["id"]] = {key: annotation[key] for key in keep}
+    return previous
 
 
-# gloablly map all columns to the function that calculate them. might need to REGISTER more?
-COLUMN_MAP = {"license": check_license, "functions": parse_functions, "test": run_shader}
+def stem_shards(directory, stem) -> list:
+    """
+    existing shards with this stem, in any format
+    """
+    paths = [os.path.join(directory, shard_name(stem, shard_format)) for shard_format in SHARD_FORMATS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def find_shard(directory, stem):
+    """
+    existing shard with this stem in any format, or None
+    """
+    shards = stem_shards(directory, stem)
+    return shards[0] if shards else None
+
+
+def _percentile(sorted_values, p: float) -> float:
+    # nearest rank
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+class AnnotationProfile:
+    """
+    Collects the wall time of every column (and the shared parse) per shader, across all worker processes.
+    Keeps the `top_k` slowest shader ids per column, and counts the outcomes of the test column.
+    """
+    def __init__(self, top_k: int = 20):
+        self.top_k = top_k
+        self.timings = {}  # column -> array of seconds
+        self.slowest = {}  # column -> min heap of (seconds, id, code bytes)
+        self.test_outcomes = Counter()
+        self.start = time.perf_counter()
+
+    def add(self, annotation: dict, timings: dict) -> None:
+        code_length = len(annotation.get("image_code", "").encode("utf-8"))
+        for col, seconds in timings.items():
+            self.timings.setdefault(col, array("d")).append(seconds)
+            heap = self.slowest.setdefault(col, [])
+            entry = (seconds, annotation["id"], code_length)
+            if len(heap) < self.top_k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        if "test" in timings:
+            self.test_outcomes[annotation["test"]] += 1
+
+    def collect(self, annotations):
+        """
+        passes the annotations through, taking out the timings update_shader put there
+        """
+        for annotation in annotations:
+            timings = annotation.pop("_timings", None)
+            if timings is not None:
+                self.add(annotation, timings)
+            yield annotation
+
+    def report(self) -> dict:
+        columns = {}
+        for col, values in self.timings.items():
+            values = sorted(values)
+            columns[col] = {
+                "count": len(values),
+                "total_s": sum(values),
+                "mean_s": sum(values) / len(values),
+                "p50_s": _percentile(values, 50),
+                "p95_s": _percentile(values, 95),
+                "p99_s": _percentile(values, 99),
+                "max_s": values[-1],
+                "slowest": [
+                    {"id": shader_id, "seconds": seconds, "code_bytes": code_length}
+                    for seconds, shader_id, code_length in sorted(self.slowest[col], reverse=True)
+                ],
+            }
+        if "test" in columns:
+            tested = sum(self.test_outcomes.values())
+            columns["test"]["outcomes"] = dict(self.test_outcomes)
+            columns["test"]["timeouts"] = self.test_outcomes["timeout"]
+            columns["test"]["error_rate"] = (self.test_outcomes["error"] + self.test_outcomes["panic"]) / tested
+        return {"wall_time_s": time.perf_counter() - self.start, "columns": columns}
+
+    def write(self, path) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def apply_chunk(func, chunk: list) -> list:
+    # the tests of all records in the chunk are started before waiting for the first one
+    return [resolve_columns(annotation) for annotation in [func(record) for record in chunk]]
+
+
+def map_records(func, records, pool=None, chunk_size=16, max_pending=8):
+    """
+    lazily applies func to all records, spread across the pool if one is given. The order of the results is kept.
+    At most `max_pending` chunks are in flight, so memory stays bounded no matter how many records there are.
+    """
+    records = iter(records)
+    if pool is None:
+        while chunk := list(islice(records, chunk_size)):
+            yield from apply_chunk(func, chunk)
+        return
+    pending = deque()
+    while chunk := list(islice(records, chunk_size)):
+        pending.append(pool.apply_async(apply_chunk, (func, chunk)))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def update_annotations(annotations, columns: list, ids: set = None, pool=None, chunk_size=16, max_pending=8, buffer_size=1024):
+    """
+    streams through annotations and updates the columns of those with an id in `ids` (all if None).
+    only `buffer_size` records are held at a time, the others are passed through in order.
+    """
+    annotations = iter(annotations)
+    update_func = partial(update_shader, columns=columns, resolve=False)
+    while window := list(islice(annotations, buffer_size)):
+        to_update = [idx for idx, annotation in enumerate(window) if ids is None or annotation["id"] in ids]
+        updated = map_records(update_func, [window[idx] for idx in to_update], pool, chunk_size, max_pending)
+        for idx, annotation in zip(to_update, updated):
+            window[idx] = annotation
+        yield from window
+
 
 if __name__ == "__main__":
     args = argument_parser.parse_args()
@@ -307,62 +837,88 @@ if __name__ == "__main__":
     output_dir = args.output
     columns = [col.strip() for col in args.columns.split(",")] #if col in list(COLUMN_MAP.values()) + ["all"]]
     print(f"{columns=}")
-
+    LICENSE_CACHE_PATH = args.license_cache or None
+    TEST_WORKERS = args.test_workers
+    TEST_CACHE_PATH = args.test_cache or None
+    PROFILE = args.profile is not None
+    profile = AnnotationProfile() if PROFILE else None
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(LICENSE_CACHE_PATH, TEST_WORKERS, TEST_CACHE_PATH, PROFILE))
+    max_pending = 2 * args.workers  # keeps every worker busy while bounding what's in memory
 
     if args.mode == "redo":
         print(f"annotating all .jsonlines files in {input_dir}")
+        # with two formats of the same shard it's unclear which one is current, and both would be loaded later on
+        for file in os.listdir(input_dir):
+            if is_shard(file) and len(stem_shards(output_dir, shard_stem(file))) > 1:
+                argument_parser.error(f"{output_dir} holds {shard_stem(file)} in more than one format: {stem_shards(output_dir, shard_stem(file))}, remove the stale one first")
         for file in tqdm(os.listdir(input_dir)):
-            if not file.endswith(".jsonl"):
+            if not is_shard(file):
                 tqdm.write(f"Skipping file {file}")
                 continue
             source = "api" #default?
             if file.startswith("20k"): #should we do api_ prefix for the others?
                 source = "shaders20k"
             tqdm.write(f"Annotating {file}")
-            with jsonlines.open(os.path.join(input_dir, file), "r") as reader:
-                shaders = list(reader)
-            annotated_shaders = []
-            for shader in tqdm(shaders):
-                annotated_shaders.append(annotate_shader(shader, columns=columns, access=source))
-            
-            output_path = os.path.join(output_dir, file)
-            with jsonlines.open(output_path, mode="w") as writer:
-                for shader in annotated_shaders:
-                    writer.write(shader)
+            output_file = file if args.format is None else shard_name(shard_stem(file), args.format)
+            output_path = os.path.join(output_dir, output_file)
+            # columns of unchanged shaders are copied over from the last run, only what changed is recomputed
+            previous = {}
+            previous_path = None if args.force else find_shard(output_dir, shard_stem(output_file))
+            if previous_path is not None:
+                previous = load_previous(previous_path, expand_columns(columns))
+            shaders = ((shader, previous.get(record_id(shader))) for shader in iter_shard(os.path.join(input_dir, file)))
+            annotate_func = partial(annotate_with_previous, columns=columns, access=source)
+            annotated_shaders = map_records(annotate_func, shaders, pool, args.chunk_size, max_pending)
+            if profile is not None:
+                annotated_shaders = profile.collect(annotated_shaders)
+
+            # streamed into a temporary file that replaces the old one at the end, an interrupted run never leaves a truncated shard
+            offsets = replace_shard(output_path, tqdm(annotated_shaders, leave=False))
+            # the shard in its previous format (--format changed) would be loaded next to the new one
+            for stale_path in stem_shards(output_dir, shard_stem(output_file)):
+                if stale_path != output_path:
+                    remove_shard(stale_path)
+                    tqdm.write(f"Removed {stale_path}, replaced by {output_file}")
+            set_shard_ids(output_dir, output_file, list(offsets))
             tqdm.write(f"Annotated {file} to {output_path}")
 
     elif args.mode == "update":
         if args.ids == "":
             ids = None
             print(f"updating all .jsonlines files in {output_dir}")
-        elif args.ids.endswith(".txt"):
-            ids = read_ids(args.ids)
+            files = [file for file in os.listdir(output_dir) if is_shard(file)]
         else:
-            isinstance(args.ids, str)
-            ids = args.ids.split(",")
-        print(f"updating {len(ids)} shaders in {output_dir}")
-        for file in tqdm(os.listdir(output_dir)):
-            if not file.endswith(".jsonl"):
-                tqdm.write(f"Skipping file {file}")
-                continue
-            with jsonlines.open(os.path.join(output_dir, file), "r") as reader:
-                old_annotations = list(reader)
-            new_annotations = []
-            for annotation in tqdm(old_annotations):
-                # we still run through all of them just to find the one id we want?
-                if ids is None or annotation["id"] in ids:
-                    # ids.remove(annotation["id"]) # be careful to never reach an empty list?
-                    # TODO: use empty list as an early exit?
-                    new_annotations.append(update_shader(annotation, columns=columns))
-                else:
-                    new_annotations.append(annotation)
-
-            # TODO: DRY - don't repeat yourself?
+            if args.ids.endswith(".txt"):
+                ids = set(read_ids(args.ids))
+            else:
+                ids = set(args.ids.split(","))
+            # only the shards that hold any of the ids are read and rewritten
+            id_index = load_id_index(output_dir)
+            missing = ids - id_index.keys()
+            if missing:
+                print(f"{len(missing)} ids not found in {output_dir}: {sorted(missing)[:10]}...")
+            files = sorted({file for shader_id in ids - missing for file in id_index[shader_id]})
+            print(f"updating {len(ids - missing)} shaders in {len(files)} files in {output_dir}")
+        for file in tqdm(files):
             output_path = os.path.join(output_dir, file)
-            with jsonlines.open(output_path, mode="w") as writer:
-                for shader in new_annotations:
-                    writer.write(shader)
-            tqdm.write(f"Annotated {file} to {output_path}")
+            new_annotations = update_annotations(
+                iter_shard(output_path), columns, ids, pool, args.chunk_size, max_pending, args.buffer_size
+            )
+            if profile is not None:
+                new_annotations = profile.collect(new_annotations)
+            # streamed into a temporary file first, so a crash never leaves a truncated shard
+            offsets = replace_shard(output_path, tqdm(new_annotations, leave=False))
+            set_shard_ids(output_dir, file, list(offsets))
+            tqdm.write(f"Updated {output_path}")
 
     else:
-        print(f"unrecognized mode {args.mode}, please chose either `update` or `redo`")
\ No newline at end of file
+        print(f"unrecognized mode {args.mode}, please chose either `update` or `redo`")
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if profile is not None:
+        profile.write(args.profile)
+        print(f"wrote profile to {args.profile}")
\ No newline at end of file
@@ -0,0 +1,267 @@
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+# the renderer is replaced by a stand-in, so the pool and the pipeline around it are measured, not the GPU
+os.environ["SHADER_TEST_BACKEND"] = "fake"
+
+import pandas as pd
+
+import annotate
+import filter as filters
+import frequency
+from cache import CACHE_DIR
+from storage import iter_shard, replace_shard, shard_name
+
+BASELINE_FILE = os.path.join(CACHE_DIR, "benchmark_baseline.json")  # timings depend on the machine, so the baseline isn't part of the repo
+MEMORY_FLOOR = 1.0  # MiB, differences in peak memory below this are noise
+MIN_ROUND_TIME = 0.2  # seconds, fast benchmarks are repeated within a round until they took this long
+
+argument_parser = argparse.ArgumentParser(description="measures the hot paths of the dataset build and compares them against a stored baseline")
+argument_parser.add_argument("--raw", type=str, default="./data/raw_test/", help="directory of raw shards to sample the corpus from")
+argument_parser.add_argument("--annotated", type=str, default="./data/annotated_test/", help="directory of annotated shards to sample the corpus from")
+argument_parser.add_argument("--scale", type=int, default=5, help="the corpus is repeated this many times (with new ids), to get measurable timings")
+argument_parser.add_argument("--rounds", type=int, default=3, help="every benchmark is timed this many times, the fastest round counts")
+argument_parser.add_argument("--only", type=str, default="", help="comma separated list of benchmarks to run, all if empty")
+argument_parser.add_argument("--baseline", type=str, default=BASELINE_FILE, help=f"json file with the stored baseline of this machine (default {BASELINE_FILE})")
+argument_parser.add_argument("--save", action="store_true", help="store the results as the new baseline instead of comparing against it")
+argument_parser.add_argument("--tolerance", type=float, default=0.25, help="relative slowdown (or memory growth) that counts as a regression")
+argument_parser.add_argument("--output", type=str, default="", help="also write the results of this run to a json file")
+
+
+def load_records(directory) -> list:
+    records = []
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        if os.path.isfile(path) and not file.startswith("."):
+            records.extend(iter_shard(path))
+    return records
+
+
+def scale_records(records: list, scale: int) -> list:
+    """
+    repeats the records `scale` times, copies get a suffix on their id so they look like different shaders (forks).
+    """
+    scaled = []
+    for copy_num in range(scale):
+        for record in records:
+            record = copy.deepcopy(record)
+            if copy_num:
+                info = record["Shader"]["info"] if "Shader" in record else record
+                info["id"] = f"{info['id']}_{copy_num}"
+            scaled.append(record)
+    return scaled
+
+
+def write_shards(records: list, directory, shard_format: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    replace_shard(os.path.join(directory, shard_name("bench", shard_format)), records)
+
+
+def best_time(func, make_input, rounds: int) -> float:
+    """
+    seconds per call of the fastest round
+    """
+    timings = []
+    for _ in range(rounds):
+        calls = 0
+        elapsed = 0.0
+        while elapsed < MIN_ROUND_TIME:
+            inputs = make_input()  # not timed
+            start = time.perf_counter()
+            func(inputs)
+            elapsed += time.perf_counter() - start
+            calls += 1
+        timings.append(elapsed / calls)
+    return min(timings)
+
+
+def peak_memory(func, make_input) -> float:
+    """
+    peak of python allocations while running func, in MiB. Memory allocated by arrow isn't seen by tracemalloc.
+    """
+    inputs = make_input()
+    tracemalloc.start()
+    try:
+        func(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+def apply_function_filters(func_df: pd.DataFrame) -> dict:
+    """
+    the function filters depend on each other (e.g. construct_inp before filter_duplicates), so each one gets the output of the previous one.
+    """
+    inputs = {}
+    for f in filters.FUNCTION_STEPS:
+        inputs[f.__name__] = func_df.copy()
+        func_df = f(func_df)
+    return inputs
+
+
+def add_program_columns(program_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    the program filters don't depend on each other, but some read columns that a step adds (like add_program_signatures), those are added to every input.
+    """
+    for f in filters.PROGRAM_STEPS:
+        spec = filters.FILTER_SPECS[f]
+        if spec.get("adds") and not spec.get("set_wise"):
+            program_df = f(program_df.copy())
+    return program_df
+
+
+def stream_programs(data_dir, spill_dir) -> list:
+    program_filters = [f for f in filters.PROGRAM_STEPS if f is not filters.filter_licenses]  # fetches the license list over the network
+    return filters.stream_filters(filters.iter_data(data_dir, columns=filters.PROGRAM_COLUMNS), program_filters, spill_dir, unit="shaderprograms")
+
+
+def collect_benchmarks(raw_records: list, annotated_records: list, work_dir) -> list:
+    """
+    returns a list of (name, make_input, func), where make_input returns a fresh input and func processes it.
+    The number of records is the length of the input.
+    """
+    jsonl_dir = os.path.join(work_dir, "jsonl/")
+    parquet_dir = os.path.join(work_dir, "parquet/")
+    write_shards(annotated_records, jsonl_dir, "jsonl")
+    write_shards(annotated_records, parquet_dir, "parquet")
+    codes = [record["image_code"] for record in annotated_records]
+    unique_codes = list(dict.fromkeys(codes))  # scancode is slow, the copies don't add anything
+    program_df = filters.load_data(jsonl_dir)
+    func_df = filters.expand_functions(program_df.copy())
+    filter_inputs = apply_function_filters(func_df)
+    program_input = add_program_columns(program_df)
+    spill_dir = os.path.join(work_dir, "spill/")
+    os.makedirs(spill_dir, exist_ok=True)
+
+    def parse_all(code_list):
+        annotate.parse_code.cache_clear()  # measure parsing, not the cache
+        return [annotate.parse_functions(code) for code in code_list]
+
+    def test_all(code_list):
+        # the copies of a code within one round are forks and may hit the in-process caches, earlier rounds may not
+        annotate.parse_code.cache_clear()
+        annotate.code_names.cache_clear()
+        return [annotate.run_shader(code, pool=pool) for code in code_list]
+
+    pool = annotate.get_pool(annotate.TEST_WORKERS, backend="fake")
+    benchmarks = [
+        ("flatten_shader_data", lambda: copy.deepcopy(raw_records), lambda records: [annotate.flatten_shader_data(r) for r in records]),
+        ("parse_functions", lambda: codes, parse_all),
+        ("check_license", lambda: unique_codes, lambda code_list: [annotate.check_license(code) for code in code_list]),
+        ("run_shader", lambda: codes, test_all),
+        ("load_data[jsonl]", lambda: [None] * len(annotated_records), lambda _: filters.load_data(jsonl_dir)),
+        ("load_data[parquet]", lambda: [None] * len(annotated_records), lambda _: filters.load_data(parquet_dir)),
+        ("expand_functions", lambda: program_df.copy(), filters.expand_functions),
+        ("stream_filters[programs]", lambda: [None] * len(annotated_records), lambda _: stream_programs(jsonl_dir, spill_dir)),
+        ("count_functions", lambda: [None] * len(annotated_records), lambda _: frequency.count_functions(jsonl_dir)),
+    ]
+    for f in filters.PROGRAM_STEPS:
+        if f is filters.filter_licenses:
+            continue  # fetches the license list over the network
+        benchmarks.append((f.__name__, lambda: program_input.copy(), f))
+    for f in filters.FUNCTION_STEPS:
+        benchmarks.append((f.__name__, lambda name=f.__name__: filter_inputs[name].copy(), f))
+    return benchmarks
+
+
+def run_benchmarks(benchmarks: list, rounds: int = 3, only: list = None) -> dict:
+    results = {}
+    for name, make_input, func in benchmarks:
+        if only and name not in only:
+            continue
+        records = len(make_input())
+        seconds = best_time(func, make_input, rounds)
+        results[name] = {
+            "records": records,
+            "seconds": seconds,
+            "records_per_s": records / seconds if seconds > 0 else float("inf"),
+            "peak_mib": peak_memory(func, make_input),
+        }
+        print(f"{name:<24} {records:>7} records {seconds:>9.4f}s {results[name]['records_per_s']:>12.1f} records/s {results[name]['peak_mib']:>9.2f} MiB")
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    names and reasons of the benchmarks that got slower or need more memory than the baseline allows
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["records_per_s"] < base["records_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['records_per_s']:.1f} records/s, baseline {base['records_per_s']:.1f} records/s")
+        if result["peak_mib"] - base["peak_mib"] > MEMORY_FLOOR and result["peak_mib"] > base["peak_mib"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {result['peak_mib']:.2f} MiB, baseline {base['peak_mib']:.2f} MiB")
+    return regressions
+
+
+def machine_info(args) -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "rounds": args.rounds,
+    }
+
+
+if __name__ == "__main__":
+    args = argument_parser.parse_args()
+    only = [name.strip() for name in args.only.split(",") if name.strip()]
+    # caches would turn the second round into a lookup, measure the actual work
+    annotate.LICENSE_CACHE_PATH = None
+    annotate.TEST_CACHE_PATH = None
+
+    raw_records = scale_records(load_records(args.raw), args.scale)
+    annotated_records = scale_records(load_records(args.annotated), args.scale)
+    print(f"corpus: {len(raw_records)} raw and {len(annotated_records)} annotated shaders")
+    annotate.check_license("// MIT License\nvoid mainImage(out vec4 c, in vec2 p){}")  # loads the license index
+
+    work_dir = tempfile.mkdtemp(prefix="shadertoys_bench_")
+    try:
+        results = run_benchmarks(collect_benchmarks(raw_records, annotated_records, work_dir), args.rounds, only)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"machine": machine_info(args), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save:
+        if only and os.path.exists(args.baseline):
+            # only replace the benchmarks that were run
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            report["results"] = {**stored["results"], **results}
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save to create one")
+        sys.exit(0)
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["machine"] != report["machine"]:
+        print(f"warning: baseline was measured on {baseline['machine']}, this run is {report['machine']}")
+    regressions = find_regressions(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regressions (tolerance {args.tolerance:.0%}):")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.getenv("SHADERTOY_CACHE_DIR", "./data/cache/")
+MISSING = object()  # sentinel, since None is a valid cached value
+
+
+def hash_key(*parts: str) -> str:
+    """
+    content address for the given strings
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class SqliteCache:
+    """
+    Small persistent key -> value cache on top of sqlite, for results that are expensive to recompute.
+    Entries are stamped with a `version` (e.g. the version of the tool that computed them), opening the cache
+    with a different version clears it. Once it holds more than `max_entries`, the least recently used entries are evicted.
+    Values need to be json serializable. Safe to use from several processes, and from several threads (they share one connection).
+    """
+    def __init__(self, path, version: str, max_entries: int = 100_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)  # autocommit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def get(self, key: str, default=MISSING):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, json.dumps(value), time.time())
+            )
+            self._writes += 1
+            evict = self._writes % 1000 == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        drop the least recently used entries above `max_entries`
+        """
+        with self._lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,175 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from annotate import GLSL_BUILTIN_FUNCTIONS, parse_code
+
+# near duplicate detection with MinHash + LSH over normalized token streams.
+# Forks that only rename identifiers, change constants or reformat the code end up with the same tokens.
+SHINGLE_SIZE = 5  # tokens per shingle
+NUM_PERM = 128  # minhash permutations, the length of a signature
+BANDS = 16  # LSH bands, with NUM_PERM // BANDS rows each. Pairs above a similarity of about (1/BANDS)**(BANDS/NUM_PERM) ~ 0.7 become candidates
+THRESHOLD = 0.8  # estimated jaccard similarity candidates need to be merged into a cluster
+SEED = 42
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+_rng = np.random.default_rng(SEED)
+# a < 2**31 and 32 bit shingle hashes, so a * h + b never overflows 64 bit
+_PERM_A = _rng.integers(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+
+
+def code_tokens(code, start_byte: int = 0, end_byte: int = None) -> list:
+    """
+    normalized tokens of the code (or the part between the byte-indices), comments are skipped.
+    Identifiers become ID and numbers NUM, keywords, types, swizzles, operators and calls of builtin functions are kept.
+    The parse is cached, so tokens of several functions from one program only parse it once.
+    """
+    code_bytes = code if isinstance(code, bytes) else bytes(code, encoding="utf-8")
+    if end_byte is None:
+        end_byte = len(code_bytes)
+    tokens = []
+    cursor = parse_code(code_bytes).walk()
+    while True:
+        node = cursor.node
+        node_type = node.type
+        if node.end_byte <= start_byte or node.start_byte >= end_byte or node_type == "comment":
+            pass
+        elif node_type == "identifier":
+            text = node.text.decode("utf-8", errors="replace")
+            tokens.append(text if text in GLSL_BUILTIN_FUNCTIONS else "ID")
+        elif node_type == "number_literal":
+            tokens.append("NUM")
+        elif node_type == "preproc_arg" or not cursor.goto_first_child():
+            text = " ".join(node.text.decode("utf-8", errors="replace").split())
+            if text:
+                tokens.append(text)
+        else:
+            continue  # went down to the first child
+        # next sibling, or up until there is one
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent():
+                return tokens
+
+
+def shingle_hashes(tokens: list, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """
+    32 bit hashes of all distinct runs of `size` tokens (the whole stream if it's shorter)
+    """
+    if not tokens:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {"\0".join(tokens[i:i + size]) for i in range(max(1, len(tokens) - size + 1))}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+
+def minhash(hashes: np.ndarray) -> np.ndarray:
+    """
+    signature of a set of shingle hashes, the minimum of NUM_PERM random permutations
+    """
+    if len(hashes) == 0:
+        return np.full(NUM_PERM, _MAX_HASH, dtype=np.uint64)
+    permuted = (hashes[:, None] * _PERM_A[None, :] + _PERM_B[None, :]) % _PRIME & _MAX_HASH
+    return permuted.min(axis=0)
+
+
+def signatures(token_lists: list) -> np.ndarray:
+    if not token_lists:
+        return np.empty((0, NUM_PERM), dtype=np.uint64)
+    return np.stack([minhash(shingle_hashes(tokens)) for tokens in token_lists])
+
+
+def _find(parents: np.ndarray, idx: int) -> int:
+    root = idx
+    while parents[root] != root:
+        root = parents[root]
+    while parents[idx] != root:  # path compression
+        parents[idx], idx = root, parents[idx]
+    return root
+
+
+def cluster_signatures(sigs: np.ndarray, threshold: float = THRESHOLD) -> np.ndarray:
+    """
+    groups rows with similar signatures, returns a cluster id per row (the position of the first row of its cluster).
+    Rows only get compared if they share a whole band of the signature, and then only against the first row in that bucket,
+    so it doesn't get quadratic even when thousands of functions are identical.
+    """
+    num_rows = len(sigs)
+    parents = np.arange(num_rows)
+    empty = (sigs == _MAX_HASH).all(axis=1)  # no tokens, nothing to compare
+    rows_per_band = NUM_PERM // BANDS
+    for band in range(BANDS):
+        buckets = {}
+        band_values = sigs[:, band * rows_per_band:(band + 1) * rows_per_band]
+        for idx in range(num_rows):
+            if empty[idx]:
+                continue
+            key = band_values[idx].tobytes()
+            first = buckets.setdefault(key, idx)
+            if first == idx:
+                continue
+            root_first, root_idx = _find(parents, first), _find(parents, idx)
+            if root_first == root_idx:
+                continue
+            if np.mean(sigs[first] == sigs[idx]) >= threshold:
+                # the smaller position becomes the root, so ids are stable
+                parents[max(root_first, root_idx)] = min(root_first, root_idx)
+    return np.array([_find(parents, idx) for idx in range(num_rows)], dtype=np.int64)
+
+
+def signature_column(sigs: np.ndarray) -> list:
+    """
+    one bytes object per signature, to keep them in a DataFrame column (and parquet)
+    """
+    return [sig.tobytes() for sig in sigs]
+
+
+def signature_matrix(column) -> np.ndarray:
+    return np.frombuffer(b"".join(column), dtype=np.uint64).reshape(-1, NUM_PERM)
+
+
+def program_signatures(dataframe: pd.DataFrame) -> np.ndarray:
+    return signatures([code_tokens(code) for code in dataframe["image_code"]])
+
+
+def function_signatures(dataframe: pd.DataFrame) -> np.ndarray:
+    """
+    signatures of the functions of expand_functions, from the start of the header to the end of the body.
+    """
+    encoded = {}  # functions of one program share the encoding (and the cached parse)
+    token_lists = []
+    for code, func_bytes in zip(dataframe["image_code"], dataframe["func_bytes"]):
+        if code not in encoded:
+            encoded[code] = bytes(code, encoding="utf-8")
+        token_lists.append(code_tokens(encoded[code], func_bytes[1], func_bytes[4]))
+    return signatures(token_lists)
+
+
+def add_cluster_columns(dataframe: pd.DataFrame, sigs: np.ndarray, threshold: float = THRESHOLD, prefix: str = "") -> pd.DataFrame:
+    """
+    adds {prefix}cluster_id and {prefix}cluster_size columns for the signatures of the rows
+    """
+    cluster_ids = cluster_signatures(sigs, threshold)
+    dataframe = dataframe.copy()
+    dataframe[f"{prefix}cluster_id"] = cluster_ids
+    dataframe[f"{prefix}cluster_size"] = np.bincount(cluster_ids, minlength=len(cluster_ids))[cluster_ids] if len(cluster_ids) else cluster_ids
+    return dataframe
+
+
+def cluster_programs(dataframe: pd.DataFrame, threshold: float = THRESHOLD, prefix: str = "program_") -> pd.DataFrame:
+    """
+    adds program_cluster_id and program_cluster_size columns, shader programs in one cluster have a near identical image_code.
+    """
+    return add_cluster_columns(dataframe, program_signatures(dataframe), threshold, prefix)
+
+
+def cluster_functions(dataframe: pd.DataFrame, threshold: float = THRESHOLD, prefix: str = "") -> pd.DataFrame:
+    """
+    adds cluster_id and cluster_size columns for the functions of expand_functions.
+    """
+    return add_cluster_columns(dataframe, function_signatures(dataframe), threshold, prefix)
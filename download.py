@@ -1,19 +1,32 @@
 import requests
 import json
-import jsonlines
 import tqdm
 
 import shutil
 import argparse
 import os
 import datetime
-import tempfile
 import zipfile
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from storage import PUBLISHED_NAMES, ShardWriter, is_shard, iter_shard, read_record, record_id, replace_shard, shard_name
 
 SHADERTOY_KEY = os.getenv("SHADERTOY_KEY")
+# can be pointed at a local stub server for testing
+API_URL = os.getenv("SHADERTOY_API", "https://www.shadertoy.com/api/v1")
 HEADERS = {
     "user-agent": "python script to download shadertoys dataset for: https://github.com/Vipitis/shadertoys-dataset"
 }
+REQUEST_TIMEOUT = 30  # seconds per single request
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# these live next to the monthly .jsonl files in the output dir
+# id -> file, byte offset, ver, time_retrieved. One per source, so the API and the shaders20k import only skip ids they stored themselves
+INDEX_FILES = {"api": "shader_index.tsv", "shaders20k": "shader_index_20k.tsv"}
+CHECKPOINT_FILE = "checkpoint.txt"  # ids of an unfinished run
+DATE_20K = datetime.datetime(year=2021, month=10, day=1).isoformat()  # Ocotber 2021 according to repo
 
 argument_parser = argparse.ArgumentParser()
 
@@ -41,14 +54,54 @@ argument_parser.add_argument(
     default=None,
     help="Number of shaders to download, overwritten if ids is provided",
 )
+argument_parser.add_argument(
+    "--workers",
+    type=int,
+    default=8,
+    help="Number of concurrent requests to the API, or worker processes for shaders20k",
+)
+argument_parser.add_argument(
+    "--rate_limit",
+    type=float,
+    default=10.0,
+    help="Maximum number of requests per second across all workers, 0 disables the limit",
+)
+argument_parser.add_argument(
+    "--chunk_size",
+    type=int,
+    default=1000,
+    help="Number of ids downloaded before the results are written to disk",
+)
+argument_parser.add_argument(
+    "--retries",
+    type=int,
+    default=5,
+    help="How often a request is retried on 429/5xx or connection errors",
+)
+argument_parser.add_argument(
+    "--overwrite",
+    action="store_true",
+    help="Download ids that are already in the index again and replace the stored records",
+)
+argument_parser.add_argument(
+    "--format",
+    type=str,
+    default="jsonl",
+    choices=["jsonl", "zst"],
+    help="Storage format for new monthly files: plain .jsonl or block compressed .jsonl.zst with a sidecar index",
+)
+argument_parser.add_argument(
+    "--max_age",
+    type=float,
+    default=None,
+    help="In update mode, also refetch shaders whose stored copy is older than this many days",
+)
 
 
 def scrape_to_api(json_data: dict) -> dict:
     """
     transform the dict to be exactly like the API return would provide it
     """
-    privacy_keys = {0: "Private", 1: "Public", 2: "Unlisted", 3: "Public API", 4: "Anonymous"}
-    
     shader_data = {
         "Shader": {
             "info": json_data["info"],
@@ -63,76 +116,143 @@ def scrape_to_api(json_data: dict) -> dict:
             inp["ctype"] = inp.pop("type")
 
     # TODO: that seems be be incorrect, download gives these. scrape and API gives numbers -.-
-    shader_data["Shader"]["info"]["published"] = privacy_keys.get(shader_data["Shader"]["info"]["published"], "Unknown")
+    shader_data["Shader"]["info"]["published"] = PUBLISHED_NAMES.get(shader_data["Shader"]["info"]["published"], "Unknown")
 
     return shader_data
 
 
-def get_shaders20k(data_dir="./data/raw/"):
+def convert_shaders20k(raw_bytes: bytes) -> dict:
+    """
+    turns one file of the shaders20k archive into the API format, runs in the worker pool
+    """
+    shader_data = scrape_to_api(json.loads(raw_bytes))
+    shader_data["Shader"]["time_retrieved"] = DATE_20K
+    return shader_data
+
+
+def get_shaders20k(data_dir="./data/raw/", workers: int = None, batch_size: int = 1024, shard_format: str = "jsonl"):
+    """
+    Streams the shaders directly out of the all_codes.zip archive, no extraction to disk needed.
+    Conversion is spread across a process pool and every monthly file is opened just once.
+    Shaders already imported to `data_dir` are skipped, copies downloaded from the API don't matter.
+    """
     zip_path = os.path.join(data_dir, "shaders20k", "all_codes.zip")
     # ./data/ids/shaders20k.txt
     ids_dest = os.path.abspath("./data/ids/shaders20k.txt")
-    date_20k = datetime.datetime(year=2021, month=10, day=1).isoformat()  # Ocotber 2021 according to repo
 
     if not os.path.exists(zip_path):
         raise NotImplementedError(
             "use the original script for now: https://github.com/mbaradad/shaders21k/blob/main/scripts/download/download_shader_codes.sh"
         )
 
+    index = load_index(data_dir, source="shaders20k")
+    new_entries = {}
+    writers = {}  # one open writer per month
     # ids in shader_codes/shaders_info/shadertoy_urls -> save to data/ids/shaders20k.txt
-    # shader files in shader_codes/shadertoy/*/ID.frag -> save to data/raw/shaders20k_*.jsonl
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
+    # shader files in shader_codes/shadertoy/*/ID.frag -> save to data/raw/20k_*.jsonl
+    with zipfile.ZipFile(zip_path, "r") as zip_ref, ProcessPoolExecutor(max_workers=workers) as pool:
         if not os.path.exists(ids_dest):
-            shutil.move(
-                os.path.join(
-                    temp_dir, "shader_codes", "shaders_info", "shadertoy_urls"
-                ),
-                ids_dest,
+            with zip_ref.open("shader_codes/shaders_info/shadertoy_urls") as src, open(ids_dest, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        members = [
+            member for member in zip_ref.infolist()
+            if member.filename.startswith("shader_codes/shadertoy/") and not member.is_dir()
+        ]
+        try:
+            with tqdm.tqdm(total=len(members)) as pbar:
+                # batches keep the amount of decompressed data in flight bounded
+                for batch_start in range(0, len(members), batch_size):
+                    batch = [zip_ref.read(member) for member in members[batch_start : batch_start + batch_size]]
+                    for shader_data in pool.map(convert_shaders20k, batch, chunksize=64):
+                        pbar.update()
+                        shader_id = shader_data["Shader"]["info"]["id"]
+                        if shader_id in index or shader_id in new_entries:
+                            continue
+                        file_name = shard_name(f"20k_{shader_month(shader_data)}", shard_format)
+                        if file_name not in writers:
+                            writers[file_name] = ShardWriter(os.path.join(data_dir, file_name), mode="a")
+                        writers[file_name].write(shader_data)
+                        new_entries[shader_id] = (file_name, None, shader_data["Shader"]["ver"], DATE_20K)
+        finally:
+            for writer in writers.values():
+                writer.close()
+            # offsets are only final once the writers are closed
+            for shader_id, (file_name, _, ver, time_retrieved) in new_entries.items():
+                new_entries[shader_id] = (file_name, writers[file_name].offsets[shader_id], ver, time_retrieved)
+            index.update(new_entries)
+            save_index_entries(data_dir, new_entries, source="shaders20k")
+    print(f"Added {len(new_entries)} shaders from {zip_path} to {len(writers)} files")
+
+
+class RateLimiter:
+    """
+    Thread safe limiter that spaces out requests to at most `rate` per second.
+    """
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    A keep-alive session with a connection pool large enough for all workers.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def api_get(endpoint: str, session=None, limiter: RateLimiter = None, retries: int = 5, backoff: float = 1.0, **params) -> dict:
+    """
+    GET a Shadertoy API endpoint and return the decoded json.
+    Retries with exponential backoff on 429/5xx responses and connection errors, honoring a `Retry-After` header.
+    """
+    http = session if session is not None else requests
+    url = f"{API_URL}/{endpoint}"
+    params["key"] = SHADERTOY_KEY
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        delay = backoff * 2**attempt + random.uniform(0, backoff)
+        try:
+            response = http.get(url, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+        else:
+            if response.status_code == 200:
+                return response.json()
+            error = requests.exceptions.HTTPError(
+                f"Failed to load {endpoint} with status code {response.status_code}"
             )
-        for root, dir, files in tqdm.tqdm(os.walk(
-            os.path.join(temp_dir, "shader_codes", "shadertoy")
-        )):
-            if not files:
-                # skip this the empty dir?
-                continue
-            # break
-            # output_path = os.path.join(data_dir, f"shaders20k_{subdir}.jsonl")
-            for file in tqdm.tqdm(files):
-                # break
-                with open(os.path.join(root, file), "r") as f:
-                    shader_data = json.loads(f.read())
-                shader_data = scrape_to_api(shader_data)
-                shader_date = datetime.datetime.fromtimestamp(
-                    float(shader_data["Shader"]["info"]["date"])
-                ).strftime("%Y-%m")
-                output_path = os.path.join(data_dir, f"20k_{shader_date}.jsonl")
-                shader_data["Shader"]["time_retrieved"] = date_20k
-                append_shaders(output_path, [shader_data])
-                # shaders.append(shader_data)
-
-
-def get_all_shaders():
-    url = "https://www.shadertoy.com/api/v1/shaders"
-    response = requests.get(
-        url, params={"key": SHADERTOY_KEY, "sort": "newest"}, headers=HEADERS
-    )
-    if response.status_code != 200:
-        raise requests.exceptions.HTTPError(
-            f"Failed to load shaders with status code {response.status_code}"
-        )
-    return response.json()["Results"]
+            if response.status_code not in RETRY_STATUS:
+                raise error
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        if attempt < retries:
+            time.sleep(delay)
+    raise error
 
 
-def get_shader(shader_id) -> dict:
-    url = f"https://www.shadertoy.com/api/v1/shaders/{shader_id}"
-    response = requests.get(url, params={"key": SHADERTOY_KEY}, headers=HEADERS)
-    if response.status_code != 200:
-        raise requests.exceptions.HTTPError(
-            f"Failed to load shader {shader_id} with status code {response.status_code}"
-        )
-    shader_data = response.json()
+def get_all_shaders(session=None, limiter: RateLimiter = None, retries: int = 5) -> list:
+    return api_get("shaders", session=session, limiter=limiter, retries=retries, sort="newest")["Results"]
+
+
+def get_shader(shader_id, session=None, limiter: RateLimiter = None, retries: int = 5) -> dict:
+    shader_data = api_get(f"shaders/{shader_id}", session=session, limiter=limiter, retries=retries)
     if "Error" in shader_data:
         raise ValueError(
             f"Failed to load shader {shader_id}: {shader_data['Error']}"
@@ -143,28 +263,213 @@ def get_shader(shader_id) -> dict:
     return shader_data
 
 
-def append_shaders(output_path, shaders: list[dict]) -> None:
+def shader_month(shader_data: dict) -> str:
     """
-    Appends shaders to a given jsonlines file.
+    from unix timestamp to year and month, used to name the monthly .jsonl files
     """
-    # TODO: overwrite if already exists!
-    with jsonlines.open(output_path, mode="a") as writer:
+    return datetime.datetime.fromtimestamp(
+        float(shader_data["Shader"]["info"]["date"])
+    ).strftime("%Y-%m")
+
+
+def download_shaders(shader_ids: list, output_dir, workers: int = 8, rate_limit: float = 10.0, chunk_size: int = 1000, retries: int = 5, index: dict = None, shard_format: str = "jsonl") -> list:
+    """
+    Downloads shaders concurrently with a shared session and writes them to monthly shards in `output_dir`.
+    Ids are processed in chunks, each chunk is written to disk once all of it's requests are done.
+    If an `index` is given, it's kept up to date and records of ids already in it are replaced.
+    Returns the list of ids that failed to download.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    session = make_session(workers)
+    limiter = RateLimiter(rate_limit)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool, tqdm.tqdm(total=len(shader_ids)) as pbar:
+        for chunk_start in range(0, len(shader_ids), chunk_size):
+            chunk = shader_ids[chunk_start : chunk_start + chunk_size]
+            futures = {
+                pool.submit(get_shader, shader_id, session, limiter, retries): idx
+                for idx, shader_id in enumerate(chunk)
+            }
+            by_month = {}
+            for future in as_completed(futures):
+                idx = futures[future]
+                pbar.update()
+                try:
+                    shader = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    tqdm.tqdm.write(f"Skipping {chunk[idx]}: {e}")
+                    failed.append(chunk[idx])
+                    continue
+                by_month.setdefault(shader_month(shader), []).append((idx, shader))
+            # keep the input order within each file, regardless of which request finished first
+            for month, shaders in sorted(by_month.items()):
+                output_path = os.path.join(output_dir, shard_name(month, shard_format))
+                append_shaders(output_path, [shader for _, shader in sorted(shaders, key=lambda x: x[0])], index=index)
+    return failed
+
+
+def append_shaders(output_path, shaders: list[dict], index: dict = None) -> None:
+    """
+    Appends shaders to a given shard (.jsonl or .jsonl.zst).
+    If an `index` (see `load_index`) is given, shaders that are already stored are removed from their file first,
+    so a re-download replaces the old record instead of duplicating it. The index is updated and saved.
+    """
+    output_dir, file_name = os.path.split(output_path)
+    new_entries = {}
+    if index is not None:
+        stale = {}
         for shader in shaders:
-            writer.write(shader)
+            shader_id = record_id(shader)
+            # only records of the same source get replaced, a 20k_* shard keeps its copy of a shader downloaded from the API
+            if shader_id in index and shard_source(index[shader_id][0]) == shard_source(file_name):
+                stale.setdefault(index[shader_id][0], set()).add(shader_id)
+        for stale_file, stale_ids in stale.items():
+            new_entries.update(remove_shaders(os.path.join(output_dir, stale_file), stale_ids))
+
+    with ShardWriter(output_path, mode="a") as writer:
+        writer.write_all(shaders)
+    for shader in shaders:
+        shader_id = record_id(shader)
+        new_entries[shader_id] = (
+            file_name,
+            writer.offsets[shader_id],
+            shader["Shader"].get("ver", ""),
+            shader["Shader"].get("time_retrieved", ""),
+        )
+
+    if index is not None:
+        index.update(new_entries)
+        save_index_entries(output_dir, new_entries, source=shard_source(file_name))
 
 
 def update_shaders(output_path, shaders: list[dict]) -> None:
-    # TODO: test and fix this!
     """
-    Updates shaders in a given jsonlines file.
+    Updates shaders in a given shard. Existing records with the same id are replaced.
+    """
+    index = load_index(os.path.dirname(output_path), source=shard_source(os.path.basename(output_path)))
+    append_shaders(output_path, shaders, index=index)
+
+
+def remove_shaders(output_path, shader_ids: set) -> dict:
+    """
+    Rewrites a shard without the given ids.
+    Returns the new index entries for all remaining shaders, as their offsets shift.
+    """
+    file_name = os.path.basename(output_path)
+    kept = {}
+
+    def remaining():
+        for shader in iter_shard(output_path):
+            shader_id = record_id(shader)
+            if shader_id not in shader_ids:
+                kept[shader_id] = (shader["Shader"].get("ver", ""), shader["Shader"].get("time_retrieved", ""))
+                yield shader
+
+    offsets = replace_shard(output_path, remaining())
+    return {shader_id: (file_name, offsets[shader_id], *kept[shader_id]) for shader_id in offsets}
+
+
+def scan_shard(path):
+    """
+    yields the index entry (id, file, offset, ver, time_retrieved) for every shader in a raw shard
+    """
+    file_name = os.path.basename(path)
+    for offset, shader in iter_shard(path, with_offsets=True):
+        shader = shader["Shader"]
+        yield shader["info"]["id"], file_name, offset, shader.get("ver", ""), shader.get("time_retrieved", "")
+
+
+def shard_source(file_name) -> str:
+    """
+    where the shaders of a raw shard come from, "shaders20k" for the 20k_* files of the import, otherwise "api"
     """
-    with jsonlines.open(output_path, mode="r") as reader:
-        existing_shaders = list(reader)
-    existing_ids = set([shader["info"]["id"] for shader in existing_shaders])
-    new_shaders = [
-        shader for shader in shaders if shader["info"]["id"] not in existing_ids
-    ]
-    append_shaders(output_path, new_shaders)
+    return "shaders20k" if file_name.startswith("20k_") else "api"
+
+
+def load_index(output_dir, source="api") -> dict:
+    """
+    Loads the persistent shader index of a source in a raw data directory as a dict of id -> (file, byte offset, ver, time_retrieved).
+    The index file is an append only log, later lines win. If there is no index yet, it's built from the shards of the source.
+    """
+    index_path = os.path.join(output_dir, INDEX_FILES[source])
+    if not os.path.exists(index_path):
+        return rebuild_index(output_dir, source=source)
+    index = {}
+    num_lines = 0
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 5:
+                # likely a line cut short by a crash, the record it points to is found again on the next rebuild
+                continue
+            shader_id, file_name, offset, ver, time_retrieved = parts
+            num_lines += 1
+            if shard_source(file_name) != source:
+                continue  # written when both sources shared one index, the other source has its own now
+            index[shader_id] = (file_name, int(offset), ver, time_retrieved)
+    if num_lines > 2 * len(index):
+        # too many outdated lines, compact the log
+        save_index_entries(output_dir, index, mode="w", source=source)
+    return index
+
+
+def rebuild_index(output_dir, source="api") -> dict:
+    """
+    Scans all shards of the source in the output dir and writes a fresh index.
+    """
+    index = {}
+    if os.path.isdir(output_dir):
+        for file in sorted(os.listdir(output_dir)):
+            if is_shard(file) and shard_source(file) == source:
+                for shader_id, *entry in scan_shard(os.path.join(output_dir, file)):
+                    index[shader_id] = tuple(entry)
+        save_index_entries(output_dir, index, mode="w", source=source)
+    return index
+
+
+def save_index_entries(output_dir, entries: dict, mode="a", source="api") -> None:
+    with open(os.path.join(output_dir, INDEX_FILES[source]), mode, encoding="utf-8") as f:
+        for shader_id, (file_name, offset, ver, time_retrieved) in entries.items():
+            f.write(f"{shader_id}\t{file_name}\t{offset}\t{ver}\t{time_retrieved}\n")
+
+
+def read_shader(output_dir, index: dict, shader_id) -> dict:
+    """
+    Random access to a single stored shader via the index.
+    """
+    file_name, offset, _, _ = index[shader_id]
+    return read_record(os.path.join(output_dir, file_name), shader_id, offset)
+
+
+def select_updates(shader_ids: list, index: dict, max_age: float = None) -> list:
+    """
+    Returns the ids that are not stored yet or whose stored copy was retrieved more than `max_age` days ago.
+    Only records in API shards can be outdated, the shaders20k import is never replaced by an update.
+    """
+    cutoff = None
+    if max_age is not None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=max_age)
+    selected = []
+    for shader_id in shader_ids:
+        entry = index.get(shader_id)
+        if entry is None:
+            selected.append(shader_id)
+        elif cutoff is not None and shard_source(entry[0]) == "api":
+            try:
+                retrieved = datetime.datetime.fromisoformat(entry[3])
+            except ValueError:
+                retrieved = None  # unknown age counts as outdated
+            if retrieved is None or retrieved < cutoff:
+                selected.append(shader_id)
+    return selected
+
+
+def write_checkpoint(output_dir, shader_ids: list) -> None:
+    """
+    Journal of the ids a --mode full run is going to download, so an interrupted run can be resumed.
+    """
+    with open(os.path.join(output_dir, CHECKPOINT_FILE), "w", encoding="utf-8") as f:
+        f.write("\n".join(shader_ids))
 
 
 def read_ids(ids_path):
@@ -187,11 +492,21 @@ if __name__ == "__main__":
     args = argument_parser.parse_args()
     print(args)
     if args.mode == "shaders20k":
-        get_shaders20k()
+        get_shaders20k(workers=args.workers, shard_format=args.format)
         exit()
 
-    if args.mode == "full":
-        shader_ids = get_all_shaders()
+    os.makedirs(args.output_dir, exist_ok=True)
+    index = load_index(args.output_dir)
+    checkpoint_path = os.path.join(args.output_dir, CHECKPOINT_FILE)
+    print(f"{len(index)} shaders already in {args.output_dir}")
+
+    # only full runs without --ids are journaled, other runs neither resume nor leave a checkpoint behind
+    journaled = args.mode == "full" and args.ids is None
+    if journaled and os.path.exists(checkpoint_path):
+        print(f"Resuming unfinished run from {checkpoint_path}")
+        shader_ids = read_ids(checkpoint_path)
+    elif args.mode in ("full", "update") and args.ids is None:
+        shader_ids = get_all_shaders(retries=args.retries)
     if args.ids is not None:
         if args.ids.endswith(".txt"):
             shader_ids = read_ids(args.ids)
@@ -202,18 +517,34 @@ if __name__ == "__main__":
 
     if args.num_shaders is not None:
         shader_ids = shader_ids[: args.num_shaders]
+    if journaled:
+        write_checkpoint(args.output_dir, shader_ids)
+    if args.overwrite:
+        pass  # stored shaders get replaced
+    elif args.mode == "update":
+        # outdated shaders are in the index already, so they get replaced
+        shader_ids = select_updates(shader_ids, index, max_age=args.max_age)
+    else:
+        shader_ids = [shader_id for shader_id in shader_ids if shader_id not in index]
     num_ids = len(shader_ids)
-    if num_ids > 1000:
-        raise NotImplementedError("Chunking not yet implemented")
 
     print(f"Total number of shaders ids: {num_ids}")
 
-    for shader_id in tqdm.tqdm(shader_ids):
-        shader = get_shader(shader_id)
-        # from unix timestamp to year and month
-        shader_date = datetime.datetime.fromtimestamp(
-            float(shader["Shader"]["info"]["date"])
-        ).strftime("%Y-%m")
-        output_path = os.path.join(args.output_dir, f"{shader_date}.jsonl")
-        append_shaders(output_path, [shader])
-    print(f"Downloaded {num_ids} shaders to {output_path}")
+    failed = download_shaders(
+        shader_ids,
+        args.output_dir,
+        workers=args.workers,
+        rate_limit=args.rate_limit,
+        chunk_size=args.chunk_size,
+        retries=args.retries,
+        index=index,
+        shard_format=args.format,
+    )
+    print(f"Downloaded {num_ids - len(failed)} shaders to {args.output_dir}")
+    if failed:
+        print(f"Failed to download {len(failed)} shaders: {failed}")
+        if journaled:
+            write_checkpoint(args.output_dir, failed)
+            print(f"Run --mode full again to retry them, the failed ids are kept in {checkpoint_path}")
+    elif journaled:
+        os.remove(checkpoint_path)
@@ -1,89 +1,199 @@
 import datasets
-import jsonlines
+import itertools
 import json
+import numpy as np
 import os
-import glob
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import argparse
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Tuple
 from tqdm.auto import tqdm
 
 # local imports
-from annotate import run_shader
+from annotate import TEST_WORKERS, get_test_cache, run_shader
+from sandbox import get_pool
+from cache import CACHE_DIR
+from dedup import THRESHOLD, add_cluster_columns, function_signatures, program_signatures, signature_column, signature_matrix
+from frequency import count_functions
+from textstats import alphabetic_ratio, char_length, contains_keywords, shader_text
+from storage import JSON_COLUMNS, SHARD_FORMATS, annotated_schema, iter_shard, list_shards, records_to_table
 
 # some init?
 tqdm.pandas()
 
+FREQUENCIES_PATH = os.path.join(CACHE_DIR, "function_frequencies.npz")
+
 argument_parser = argparse.ArgumentParser()
 argument_parser.add_argument("--input", type=str, default="./data/annotated/", help="Directory of annotated .jsonlines files. Also looks one subdirectory deeper. Defaults to ./data/annotated/")
 argument_parser.add_argument("--output", type=str, default="./data/prepared/", help="Directory to save the prepared dataset to. Defaults to ./data/prepared/")
-argument_parser.add_argument("--filters", type=str, default="all", help="Which filters to apply. Defaults to 'all'.") #TODO: negative or positive list?
+argument_parser.add_argument("--filters", type=str, default="all", help="Which filters to apply, 'all' or a comma separated list of names like 'public_api,licenses,needed'. The near duplicate filters are only used when named, e.g. 'all,near_duplicates'. Defaults to 'all'.") #TODO: negative or positive list?
+argument_parser.add_argument("--test_workers", type=int, default=os.cpu_count() or 1, help="Number of sandboxed renderers that test the variants for the needed filter in parallel. Defaults to the number of CPUs.")
+argument_parser.add_argument("--frequencies", type=str, default=FREQUENCIES_PATH, help=f"File to keep the function and header counts of the input in, they are only recounted when the input shards change. Set to an empty string to always recount. Defaults to {FREQUENCIES_PATH}")
+argument_parser.add_argument("--streaming", action="store_true", help="Filter one shard at a time and spill the intermediate results to disk, so memory doesn't grow with the input. Only the dedup filters and frequency counts go over all of it.")
+argument_parser.add_argument("--spill_dir", type=str, default=None, help="Directory for the intermediate files of --streaming, they are removed at the end. Defaults to the system temp directory.")
 
+PERMISSIVE_LICENSES_URL = "https://huggingface.co/datasets/bigcode-data/license_list/resolve/main/permissive_licenses.txt"
+PERMISSIVE_LICENSES_PATH = os.path.join(CACHE_DIR, "permissive_licenses.txt")
+PERMISSIVE_LICENSES_MAX_AGE = 30  # days
 
 
-def load_data(data_dir: os.PathLike) -> pd.DataFrame:
-    lines = []
-    top_files = glob.glob(data_dir + "*.jsonl")
-    sub_files = glob.glob(data_dir + "*/*.jsonl")
-    for file in top_files + sub_files:
-        with jsonlines.open(file) as reader:
-            for obj in reader:
-                lines.append(obj)
 
-    out_df = pd.DataFrame(lines)
-    out_df["date"] = pd.to_datetime(out_df["date"].astype(int), unit="s")
-    return out_df
+def load_shard(file: os.PathLike, columns: list = None, filters: list = None) -> pa.Table:
+    """
+    reads one annotated shard as an arrow table, with the columns and filters of load_data.
+    """
+    if file.endswith(SHARD_FORMATS["parquet"]):
+        return pq.read_table(file, columns=columns, filters=filters, schema=annotated_schema())
+    table = records_to_table(list(iter_shard(file)))
+    if filters is not None:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        table = table.select(columns)
+    return table
 
 
-def filter_public_api(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
+def table_to_frame(table: pa.Table) -> pd.DataFrame:
     """
-    only keep shaders that are published to the API.
+    converts a table of annotated shards (or of a spilled part) to a DataFrame like the annotated records:
+    nested columns as python lists, the JSON_COLUMNS loaded and date as a datetime.
     """
-    # TODO: Publish API shouldn't be in raw or annotated, this needs to be fixed in both datahalves.
-    return dataframe[dataframe["published"].isin(["Public API", 3])]
+    list_columns = [field.name for field in table.schema if pa.types.is_list(field.type) or pa.types.is_large_list(field.type)]
+    out_df = table.drop_columns(list_columns).to_pandas()
+    for name in list_columns:
+        out_df[name] = table.column(name).to_pylist()
+    for name in JSON_COLUMNS:
+        if name in out_df.columns and pa.types.is_string(table.schema.field(name).type):
+            out_df[name] = [None if value is None else json.loads(value) for value in table.column(name).to_pylist()]
+    if "date" in out_df.columns and not pa.types.is_timestamp(table.schema.field("date").type):
+        out_df["date"] = pd.to_datetime(out_df["date"].astype(int), unit="s")
+    return out_df[table.column_names]
 
 
-def filter_licenses(dataframe: pd.DataFrame, keep_base=False, **kwargs) -> pd.DataFrame:
+def load_data(data_dir: os.PathLike, columns: list = None, filters: list = None) -> pd.DataFrame:
     """
-    only keep permissive licenses.
+    loads all annotated shards in data_dir (and one subdirectory deeper) into a DataFrame.
+    columns: only load these columns (default: all)
+    filters: pyarrow filters in disjunctive normal form, e.g. [("published", "=", "Public API")]. Rows that don't match are dropped while loading.
+    .parquet shards only read the requested columns and skip row groups that can't match, other shards are converted one file at a time.
+    """
+    tables = [load_shard(file, columns=columns, filters=filters) for file in list_shards(data_dir)]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+
+    table = pa.concat_tables(tables)
+    if columns is None:
+        # annotation columns that none of the shards have
+        table = table.drop_columns([name for name in table.column_names if table.column(name).null_count == len(table)])
+    return table_to_frame(table)
+
+
+def iter_data(data_dir: os.PathLike, columns: list = None, filters: list = None):
+    """
+    like load_data, but yields one DataFrame per shard. So only a single shard is in memory at a time.
+    """
+    for file in list_shards(data_dir):
+        yield table_to_frame(load_shard(file, columns=columns, filters=filters))
+
+
+def public_api_mask(dataframe: pd.DataFrame, **kwargs) -> pd.Series:
+    # TODO: Publish API shouldn't be in raw or annotated, this needs to be fixed in both datahalves.
+    return dataframe["published"].isin(["Public API", 3]) # loading normalizes the numbers to names
+
+def filter_public_api(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
     """
-    permissive_list = requests.get("https://huggingface.co/datasets/bigcode-data/license_list/resolve/main/permissive_licenses.txt").content.decode("utf-8").split()
-    permissive_list = [license_key.lower() for license_key in permissive_list]
+    only keep shaders that are published to the API.
+    """
+    return dataframe[public_api_mask(dataframe, **kwargs)]
+
+
+def permissive_licenses() -> list:
+    """
+    the list of permissive license keys from bigcode, downloaded once and then kept in the cache dir.
+    It's fetched again after PERMISSIVE_LICENSES_MAX_AGE days, an old copy is used if that fails.
+    """
+    if os.path.exists(PERMISSIVE_LICENSES_PATH):
+        age = time.time() - os.path.getmtime(PERMISSIVE_LICENSES_PATH)
+        if age < PERMISSIVE_LICENSES_MAX_AGE * 24 * 60 * 60:
+            with open(PERMISSIVE_LICENSES_PATH, "r", encoding="utf-8") as f:
+                return f.read().split()
+    try:
+        response = requests.get(PERMISSIVE_LICENSES_URL, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException:
+        if os.path.exists(PERMISSIVE_LICENSES_PATH):
+            print(f"couldn't update the license list, using the copy in {PERMISSIVE_LICENSES_PATH}")
+            with open(PERMISSIVE_LICENSES_PATH, "r", encoding="utf-8") as f:
+                return f.read().split()
+        raise
+    content = response.content.decode("utf-8")
+    os.makedirs(os.path.dirname(os.path.abspath(PERMISSIVE_LICENSES_PATH)), exist_ok=True)
+    with open(PERMISSIVE_LICENSES_PATH, "w", encoding="utf-8") as f:
+        f.write(content)
+    return content.split()
+
+
+def licenses_mask(dataframe: pd.DataFrame, keep_base=False, **kwargs) -> pd.Series:
+    permissive_list = [license_key.lower() for license_key in permissive_licenses()]
     #TODO: figure out cases with AND and OR in the detection.
     if keep_base:
         permissive_list.append("CC-BY-NC-SA-3.0")
-    return dataframe[dataframe["license"].isin(permissive_list)]
+    return dataframe["license"].isin(permissive_list)
 
+def filter_licenses(dataframe: pd.DataFrame, keep_base=False, **kwargs) -> pd.DataFrame:
+    """
+    only keep permissive licenses.
+    """
+    return dataframe[licenses_mask(dataframe, keep_base=keep_base, **kwargs)]
+
+
+def single_pass_mask(dataframe: pd.DataFrame, **kwargs) -> pd.Series:
+    other_passes = [col for col in dataframe.columns if col.endswith("_code") and col not in ("image_code")]
+    #TODO: consider keeping sound_code and common_code (the later one needs to be prepended to the image_code)
+    return (dataframe.loc[:,other_passes] == "").all(axis=1)
 
 def filter_single_pass(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
     """
     only keep shaders that are single pass.
     """
-    other_passes = [col for col in dataframe.columns if col.endswith("_code") and col not in ("image_code")]
-    #TODO: consider keeping sound_code and common_code (the later one needs to be prepended to the image_code)
-    return dataframe[(dataframe.loc[:,other_passes] == "").all(axis=1)]
+    return dataframe[single_pass_mask(dataframe, **kwargs)]
+
 
+def no_inputs_mask(dataframe: pd.DataFrame, **kwargs) -> pd.Series:
+    # TODO: consider keeping some channel_types
+    return dataframe["image_inputs"].apply(len) == 0
 
 def filter_no_inputs(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
     """
     only keep shaders that don't require inputs.
     to be used after you filtered for single pass shaders.
     """
-    # TODO: consider keeping some channel_types
-    return dataframe[dataframe["image_inputs"].apply(len) == 0]
+    return dataframe[no_inputs_mask(dataframe, **kwargs)]
 
 #TODO: inspect if this is the case
+def words_mask(dataframe: pd.DataFrame, words=["test", "bug"], **kwargs) -> pd.Series:
+    # one matcher for all words, over name, description and tags together
+    return ~contains_keywords(shader_text(dataframe), words)
+
 def filter_words(dataframe: pd.DataFrame, words=["test", "bug"], **kwargs) -> pd.DataFrame:
     """
     Drop all shaders that contain works like "test", "debug", "ai", "chatGPT", in the title, description or tags.
     """
-    for word in words:
-        dataframe = dataframe[~dataframe["name"].str.contains(word, case=False)]
-        dataframe = dataframe[~dataframe["description"].str.contains(word, case=False)]
-        # dataframe = dataframe[~dataframe["tags"]" ".join().str.contains(word, case=False)] # can't do string opeerations on list of tags.
+    return dataframe[words_mask(dataframe, words=words, **kwargs)]
 
-    return dataframe
 
+def working_mask(dataframe: pd.DataFrame, untested=False, **kwargs) -> pd.Series:
+    # TODO: testing needs to really work before we can rely on this
+    drop_values = ["error", "panic", "timeout", "timedout", "valid", "untested"]
+    keep_values = ["ok"]
+    if untested:
+        drop_values.remove("untested")
+        keep_values.append("untested")
+    return dataframe["test"].isin(keep_values)
 
 def filter_working(dataframe: pd.DataFrame, untested=False, **kwargs) -> pd.DataFrame:
     """
@@ -91,15 +201,38 @@ def filter_working(dataframe: pd.DataFrame, untested=False, **kwargs) -> pd.Data
     Note: the idea of using `untested=True` is to first run all filters and just get a list of IDs, to then test these.
     Testing is slow and should therefore be only annotated where it's needed.
     """
+    return dataframe[working_mask(dataframe, untested=untested, **kwargs)]
 
-    # TODO: testing needs to really work before we can rely on this
-    drop_values = ["error", "panic", "timeout", "timedout", "valid", "untested"]
-    keep_values = ["ok"]
-    if untested:
-        drop_values.remove("untested")
-        keep_values.append("untested")
-    return dataframe[dataframe["test"].isin(keep_values)]
+def keep_first_per_cluster(dataframe: pd.DataFrame, cluster_col: str, sort_by="date") -> pd.DataFrame:
+    """
+    keeps the top row (earliest by default) of each cluster, in the original order
+    """
+    if sort_by not in dataframe.columns:
+        raise ValueError(f"unknown column to sort by: {sort_by}")
+    return dataframe.sort_values(by=sort_by, kind="stable").drop_duplicates(cluster_col, keep="first").sort_index()
 
+def add_program_signatures(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """
+    adds the program_signature column, the MinHash of the image_code (see dedup.py). Computed per row, so the
+    near duplicate filter only needs these and not the code.
+    """
+    dataframe["program_signature"] = signature_column(program_signatures(dataframe))
+    return dataframe
+
+def filter_near_duplicate_programs(dataframe: pd.DataFrame, similarity=THRESHOLD, sort_by="date", **kwargs) -> pd.DataFrame:
+    """
+    forks that only differ in whitespace, comments, names or constants are clustered (MinHash/LSH in dedup.py)
+    and only the earliest program of each cluster is kept. Adds the program_cluster_id and program_cluster_size columns.
+    Only the rows that are passed in get clustered, so after other filters program_cluster_size counts the forks that survived those.
+    """
+    clustered = add_cluster_columns(dataframe, signature_matrix(dataframe["program_signature"]), similarity, prefix="program_")
+    return keep_first_per_cluster(clustered, "program_cluster_id", sort_by)
+
+# everything the program filters and expand_functions look at, the other inputs and metadata aren't loaded
+PROGRAM_COLUMNS = ["id", "name", "author", "description", "tags", "published", "date", "image_code", "image_inputs", "common_code", "sound_code",
+                   "buffer_a_code", "buffer_b_code", "buffer_c_code", "buffer_d_code", "cube_a_code", "license", "functions", "test"]
+# the order of all program steps, the near duplicate ones only run when selected by name
+PROGRAM_STEPS = [filter_public_api, filter_licenses, filter_single_pass, filter_no_inputs, filter_words, filter_working, add_program_signatures, filter_near_duplicate_programs]
 PROGRAM_FILTERS = [filter_public_api, filter_licenses, filter_single_pass, filter_no_inputs, filter_words, filter_working]
 
 def filter_programs(dataframe: pd.DataFrame, filters=PROGRAM_FILTERS, **kwargs) -> pd.DataFrame:
@@ -109,12 +242,7 @@ def filter_programs(dataframe: pd.DataFrame, filters=PROGRAM_FILTERS, **kwargs)
     untested: keep untested shaders (default: False)
     keep_base: keep the base license (default: False)
     """
-    print(len(dataframe))
-
-    for f in filters:
-        dataframe = f(dataframe, **kwargs)
-        print(f"{len(dataframe)} shaderprograms remaining after {f.__name__}")
-    return dataframe
+    return run_filters(dataframe, filters, unit="shaderprograms", **kwargs)
 
 
 def combine_datasets(base_data, add_data):
@@ -130,50 +258,58 @@ def combine_datasets(base_data, add_data):
 # FUNCTION FILTERS
 # -------------------------
 def expand_functions(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    one row per function, with the parts of the function as text columns next to the byte-indices (func_bytes).
+    Each program is encoded once and all of its functions are sliced from that, the columns are built in one go.
+    """
     # TODO: likely redundant, since we keep everything... might need some cleanup instead
     cols_to_keep = ["id", "date", "image_code", "functions", "func_bytes", "author", "license"]
     #function byte indicies: start_comment, start_header, end_header, end_docstring, end_function
     func_parts = ["comment", "header", "docstring", "body"]
 
-    # TODO: do we need the whole functions for anything downstream?
-    dataframe["functions_"] = dataframe["functions"] # make a copy to keep it past explode
-    func_df = dataframe.explode("functions")
-    func_df.rename(columns={"functions": "func_bytes", "functions_": "functions"}, inplace=True)
-    func_df.dropna(subset=["func_bytes"], inplace=True) # some shaders got not functions parsed ? -> TODO: check the tree-sitter.has_error() result?
-    func_df.reset_index(inplace=True)
-    for row_idx, row in func_df.iterrows():
-        # print(row_idx, row)
-        # break
-        code = row["image_code"]
+    program_idx = []
+    func_bytes = []
+    parts = {part: [] for part in func_parts}
+    for idx, (code, functions) in enumerate(zip(dataframe["image_code"], dataframe["functions"])):
+        if not isinstance(functions, list) or not functions:
+            continue # some shaders got not functions parsed ? -> TODO: check the tree-sitter.has_error() result?
         code_bytes = bytes(code, encoding="utf-8")
-        # func_bytes = row["func_bytes"]
-        for idx, part in enumerate(func_parts):
-            start = row["func_bytes"][idx]
-            end = row["func_bytes"][idx+1]
-            func_df.at[row_idx, part] = code_bytes[start:end].decode(encoding="utf-8")
-        
-    func_df.drop(columns=func_df.columns.difference(cols_to_keep + func_parts), inplace=True)
+        for func in functions:
+            program_idx.append(idx)
+            func_bytes.append(func)
+            for part_idx, part in enumerate(func_parts):
+                parts[part].append(code_bytes[func[part_idx]:func[part_idx+1]].decode(encoding="utf-8"))
+
+    other_cols = [col for col in dataframe.columns if col in cols_to_keep and col != "functions"]
+    func_df = dataframe.iloc[program_idx][other_cols].reset_index(drop=True)
+    func_df["func_bytes"] = pd.Series(func_bytes, dtype=object)
+    func_df["functions"] = dataframe["functions"].iloc[program_idx].reset_index(drop=True)
+    for part in func_parts:
+        func_df[part] = pd.Series(parts[part], dtype="str")
     # func_df["date"] = pd.to_datetime(func_df["date"].astype(int), unit="s")
 
     return func_df
 
-def filter_has_context(dataframe: pd.DataFrame, context="comment", **kwargs) -> pd.DataFrame:
-    """
-    only keep functions that have a specific context. (not exclusive)
-    context: one of "comment", "docstring", "both", "none"
-    """
+def has_context_mask(dataframe: pd.DataFrame, context="comment", **kwargs) -> pd.Series:
     # TODO: not all are implemented
     if context == "comment":
-        return dataframe[dataframe["comment"] != ""]
+        return dataframe["comment"] != ""
     elif context == "docstring":
-        return dataframe[dataframe["docstring"] != ""]
+        return dataframe["docstring"] != ""
     elif context == "both":
-        return dataframe[(dataframe["comment"] != "") & (dataframe["docstring"] != "")]
+        return (dataframe["comment"] != "") & (dataframe["docstring"] != "")
     elif context == "none":
         raise NotImplementedError(f"not implemented yet for context: {context}")
     else:
         raise ValueError(f"unknown context: {context}")
 
+def filter_has_context(dataframe: pd.DataFrame, context="comment", **kwargs) -> pd.DataFrame:
+    """
+    only keep functions that have a specific context. (not exclusive)
+    context: one of "comment", "docstring", "both", "none"
+    """
+    return dataframe[has_context_mask(dataframe, context=context, **kwargs)]
+
 # TODO: combine construct_inp and filter_has_context into one function maybe?
 def construct_inp(dataframe: pd.DataFrame, context="comment", **kwargs) -> pd.DataFrame:
     """
@@ -191,18 +327,24 @@ def construct_inp(dataframe: pd.DataFrame, context="comment", **kwargs) -> pd.Da
         raise ValueError(f"unknown context: {context}")
     return dataframe
 
+def length_mask(dataframe: pd.DataFrame, max_length=2500, **kwargs) -> pd.Series:
+    # TODO: why chose this number?
+    return char_length(dataframe["body"]) <= max_length
+
 def filter_length(dataframe: pd.DataFrame, max_length=2500, **kwargs) -> pd.DataFrame:
     """
     sort out function bodies that are really long. (likely machine generated)
     """
-    # TODO: why chose this number?
-    return dataframe[dataframe["body"].apply(len) <= max_length]
+    return dataframe[length_mask(dataframe, max_length=max_length, **kwargs)]
+
+def alphabetic_mask(dataframe: pd.DataFrame, column="comment", cutoff=0.25, **kwargs) -> pd.Series:
+    return alphabetic_ratio(dataframe[column]) > cutoff # empty strings have no ratio and are dropped
 
 def filter_alphabetic(dataframe: pd.DataFrame, column="comment", cutoff=0.25, **kwargs) -> pd.DataFrame:
     """
     sort out functions that have an alphabetic ration above the cutoff.
     """
-    return dataframe[dataframe[column].apply(lambda x: sum(c.isalpha() for c in x) / len(x)) > cutoff]
+    return dataframe[alphabetic_mask(dataframe, column=column, cutoff=cutoff, **kwargs)]
 
 def filter_duplicates(dataframe: pd.DataFrame, sort_by="date", **kwargs) -> pd.DataFrame:
     """
@@ -219,36 +361,309 @@ def filter_duplicates(dataframe: pd.DataFrame, sort_by="date", **kwargs) -> pd.D
     # undo the sort
     return out_df.sort_index()
 
-def filter_needed(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
+def add_function_signatures(dataframe: pd.DataFrame, **kwargs) -> pd.DataFrame:
     """
-    only keep functions that are needed. By running the shader with the function removed and seeing if it errors...
+    adds the signature column, the MinHash of the function from header to body (see dedup.py)
+    """
+    dataframe["signature"] = signature_column(function_signatures(dataframe))
+    return dataframe
+
+def filter_near_duplicates(dataframe: pd.DataFrame, similarity=THRESHOLD, sort_by="date", **kwargs) -> pd.DataFrame:
+    """
+    like filter_duplicates, but for functions that are the same up to whitespace, comments, names and constants.
+    Keeps the earliest function of each cluster and adds the cluster_id and cluster_size columns.
+    Like filter_duplicates it only sees the rows that are passed in, cluster_size counts the copies left after the earlier filters.
+    """
+    clustered = add_cluster_columns(dataframe, signature_matrix(dataframe["signature"]), similarity)
+    return keep_first_per_cluster(clustered, "cluster_id", sort_by)
+
+def needed_variants(dataframe: pd.DataFrame):
+    """
+    yields (row position, code without the function) for every function. The functions of one program come one after another,
+    so its image_code is only encoded once. The function is cut out of the bytes, nothing is parsed here
+    (remove_function in annotate.py also returns the new function indices, but reparsing costs more than the cut).
+    The offsets and the code always come from the same row, an id can have two copies with different code (api and shaders20k).
+    """
+    codes = dataframe["image_code"].tolist()
+    func_bytes = dataframe["func_bytes"].tolist()
+    last_code = None
+    for pos, (code, (start_comment, start_header, end_header, end_docstring, end_function)) in enumerate(zip(codes, func_bytes)):
+        if code != last_code:
+            code_bytes = bytes(code, encoding="utf-8")
+            last_code = code
+        yield pos, (code_bytes[:start_comment] + b"\n" + code_bytes[end_function:]).decode(encoding="utf-8")
+
+def filter_needed(dataframe: pd.DataFrame, test_workers=TEST_WORKERS, timeout=10, **kwargs) -> pd.DataFrame:
     """
-    def row_needed(row):
-        # print(row["id"])
-        code_bytes = bytes(row["image_code"], encoding="utf-8")
-        start_comment, start_header, end_header, end_docstring, end_function = row["func_bytes"]
-        outer_bytes = code_bytes[:start_comment] + b"\n" +  code_bytes[end_function:]
-        test_code = outer_bytes.decode(encoding="utf-8")
-        status = run_shader(test_code)
-        return status != "ok"
-    dataframe["needed"] = dataframe.progress_apply(row_needed, axis=1)
+    only keep functions that are needed. By running the shader with the function removed and seeing if it errors...
+    The variants are tested by `test_workers` sandboxed renderers in parallel. Cached results and variants that fail the static check (see run_shader)
+    don't render, and variants that are identical (e.g. the same helper defined twice) are only tested once.
+    """
+    pool = get_pool(test_workers)
+    get_test_cache()  # open it here, not in each thread
+    max_pending = 4 * test_workers  # bounds the number of variants held in memory
+    needed = [False] * len(dataframe)
+    pending = {}  # future -> (test code, positions waiting for it)
+    running = {}  # test code -> future
+    shared = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=test_workers) as executor, tqdm(total=len(dataframe), desc="filter_needed", unit="functions") as progress:
+        def collect(done):
+            for future in done:
+                test_code, positions = pending.pop(future)
+                del running[test_code]
+                status = future.result()
+                for pos in positions:
+                    needed[pos] = status != "ok"
+                progress.update(len(positions))
+
+        for pos, test_code in needed_variants(dataframe):
+            if test_code in running:
+                pending[running[test_code]][1].append(pos)
+                shared += 1
+                continue
+            future = executor.submit(run_shader, test_code, timeouts=timeout, pool=pool)
+            running[test_code] = future
+            pending[future] = (test_code, [pos])
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    elapsed = time.perf_counter() - start
+    print(f"tested {len(dataframe)} functions in {elapsed:.1f}s ({len(dataframe) / max(elapsed, 1e-9):.1f} functions/s) with {test_workers} workers, {shared} shared a variant")
+    dataframe["needed"] = needed
     return dataframe[dataframe["needed"]]
 
 # should this be extracted to main?
+FUNCTION_STEPS = [filter_has_context, construct_inp, filter_length, filter_alphabetic, add_function_signatures, filter_duplicates, filter_near_duplicates, filter_needed]
 FUNCTION_FILTERS = [filter_has_context, construct_inp, filter_length, filter_alphabetic, filter_duplicates, filter_needed]
 def filter_functions(dataframe: pd.DataFrame, filters=FUNCTION_FILTERS, **kwargs) -> pd.DataFrame:
     """
     apply a series of filters and print the resulting numbers
     kwargs are passed to the filters
     """
-    print(len(dataframe))
+    return run_filters(dataframe, filters, unit="functions", **kwargs)
+
+
+# -------------------------
+# FILTER PLAN
+# -------------------------
+# what the planner needs to know about each filter (or step that adds columns):
+# mask: function returning the rows to keep, so cheap filters can be fused into one selection. None for steps that need the whole frame.
+# cost: 0 vectorized, 1 python per row, 2 renders shaders.
+# reads/adds: columns the step looks at and the ones it adds.
+# set_wise: the result depends on which other rows are there (like dropping duplicates), such a step is never moved past another step.
+FILTER_SPECS = {
+    filter_public_api: {"mask": public_api_mask, "cost": 0, "reads": ["published"]},
+    filter_licenses: {"mask": licenses_mask, "cost": 0, "reads": ["license"]},
+    filter_single_pass: {"mask": single_pass_mask, "cost": 0, "reads": ["common_code", "sound_code", "buffer_a_code", "buffer_b_code", "buffer_c_code", "buffer_d_code", "cube_a_code"]},
+    filter_no_inputs: {"mask": no_inputs_mask, "cost": 1, "reads": ["image_inputs"]},
+    filter_words: {"mask": words_mask, "cost": 0, "reads": ["name", "description", "tags"]},
+    filter_working: {"mask": working_mask, "cost": 0, "reads": ["test"]},  # reads the annotated test results, doesn't render
+    add_program_signatures: {"mask": None, "cost": 1, "reads": ["image_code"], "adds": ["program_signature"]},
+    filter_near_duplicate_programs: {"mask": None, "cost": 1, "reads": ["program_signature", "date"], "adds": ["program_cluster_id", "program_cluster_size"], "set_wise": True},
+    filter_has_context: {"mask": has_context_mask, "cost": 0, "reads": ["comment", "docstring"]},
+    construct_inp: {"mask": None, "cost": 0, "reads": ["comment", "header", "docstring"], "adds": ["model_inp"]},
+    filter_length: {"mask": length_mask, "cost": 0, "reads": ["body"]},
+    filter_alphabetic: {"mask": alphabetic_mask, "cost": 0, "reads": ["comment"]},
+    add_function_signatures: {"mask": None, "cost": 1, "reads": ["image_code", "func_bytes"], "adds": ["signature"]},
+    filter_duplicates: {"mask": None, "cost": 1, "reads": ["model_inp", "date"], "set_wise": True},
+    filter_near_duplicates: {"mask": None, "cost": 1, "reads": ["signature", "date"], "adds": ["cluster_id", "cluster_size"], "set_wise": True},
+    filter_needed: {"mask": None, "cost": 2, "reads": ["id", "image_code", "func_bytes"]},
+}
+
+
+def filter_name(f) -> str:
+    return f.__name__.removeprefix("filter_")
+
+
+def select_filters(names: str) -> Tuple[list, list]:
+    """
+    parses the --filters argument, "all" or a comma separated list like "public_api,licenses,needed".
+    Returns the selected program and function filters. Steps that add columns a selected filter reads (like construct_inp) are added.
+    "all" is PROGRAM_FILTERS and FUNCTION_FILTERS, the near duplicate filters have to be named, e.g. "all,near_duplicates".
+    """
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    known = {filter_name(f): f for f in PROGRAM_STEPS + FUNCTION_STEPS}
+    selected = []
+    for name in names:
+        if name == "all":
+            selected.extend(PROGRAM_FILTERS + FUNCTION_FILTERS)
+            continue
+        if name not in known:
+            raise ValueError(f"unknown filter {name}, chose from: all, {', '.join(known)}")
+        selected.append(known[name])
+    needed_columns = {col for f in selected for col in FILTER_SPECS[f]["reads"]}
+    for f in PROGRAM_STEPS + FUNCTION_STEPS:
+        if f not in selected and set(FILTER_SPECS[f].get("adds", [])) & needed_columns:
+            selected.append(f)
+    # keep the declared order, the planner takes care of the rest
+    return [f for f in PROGRAM_STEPS if f in selected], [f for f in FUNCTION_STEPS if f in selected]
+
+
+def plan_filters(filters: list, columns) -> list:
+    """
+    orders the filters so that cheap ones come first and only expensive ones see the survivors.
+    Row wise filters can be reordered freely, as long as the columns they read are there. set_wise filters stay in place.
+    """
+    available = set(columns)
+    planned = []
+    segment = []
+
+    def plan_segment():
+        remaining = list(segment)
+        while remaining:
+            ready = [f for f in remaining if set(FILTER_SPECS[f]["reads"]) <= available]
+            if not ready:
+                missing = {col for f in remaining for col in FILTER_SPECS[f]["reads"]} - available
+                raise ValueError(f"{[f.__name__ for f in remaining]} need the columns {sorted(missing)}, which nothing provides")
+            f = min(ready, key=lambda f: FILTER_SPECS[f]["cost"])  # min keeps the declared order for equal costs
+            available.update(FILTER_SPECS[f].get("adds", []))
+            planned.append(f)
+            remaining.remove(f)
+        segment.clear()
 
     for f in filters:
-        dataframe = f(dataframe, **kwargs)
-        print(f"{len(dataframe)} functions remaining after {f.__name__}")
+        if FILTER_SPECS[f].get("set_wise"):
+            plan_segment()
+            segment.append(f)
+            plan_segment()
+        else:
+            segment.append(f)
+    plan_segment()
+    return planned
+
+
+def apply_plan(dataframe: pd.DataFrame, plan: list, report, **kwargs) -> pd.DataFrame:
+    """
+    runs the planned steps. Consecutive cheap (cost 0) masks are combined and applied as one selection,
+    the other steps only get the rows that are left. report(step name, remaining rows) is called after every step.
+    """
+    idx = 0
+    while idx < len(plan):
+        keep = None
+        while idx < len(plan) and FILTER_SPECS[plan[idx]]["mask"] is not None and FILTER_SPECS[plan[idx]]["cost"] == 0:
+            mask = FILTER_SPECS[plan[idx]]["mask"](dataframe, **kwargs)
+            keep = mask if keep is None else keep & mask
+            report(plan[idx].__name__, int(keep.sum()))
+            idx += 1
+        if keep is not None:
+            dataframe = dataframe[keep]
+            continue
+        f = plan[idx]
+        if FILTER_SPECS[f]["mask"] is not None:
+            dataframe = dataframe[FILTER_SPECS[f]["mask"](dataframe, **kwargs)]
+        else:
+            dataframe = f(dataframe, **kwargs)
+        report(f.__name__, len(dataframe))
+        idx += 1
     return dataframe
 
 
+def run_filters(dataframe: pd.DataFrame, filters: list, unit: str = "rows", **kwargs) -> pd.DataFrame:
+    """
+    runs the filters in the planned order and prints the number of rows remaining after every filter.
+    """
+    print(len(dataframe))
+    plan = plan_filters(filters, dataframe.columns)
+    return apply_plan(dataframe, plan, lambda name, remaining: print(f"{remaining} {unit} remaining after {name}"), **kwargs)
+
+
+# -------------------------
+# STREAMING
+# -------------------------
+# for inputs that don't fit into memory: the data comes in parts (one per shard) and every part is filtered on its own
+# and spilled to a parquet file. Only the set_wise steps (the dedup filters) need to see all rows, they get just the columns they read.
+
+def spill_frame(dataframe: pd.DataFrame, path: os.PathLike) -> None:
+    """
+    writes a part to parquet, the JSON_COLUMNS as strings like in the shards. Read it back with read_spill.
+    """
+    dataframe = dataframe.copy()
+    for name in JSON_COLUMNS:
+        if name in dataframe.columns:
+            dataframe[name] = [None if value is None else json.dumps(value) for value in dataframe[name]]
+    pq.write_table(pa.Table.from_pandas(dataframe, preserve_index=False), path)
+
+
+def read_spill(path: os.PathLike, columns: list = None) -> pd.DataFrame:
+    return table_to_frame(pq.read_table(path, columns=columns))
+
+
+def plan_stages(plan: list) -> list:
+    """
+    splits a plan into stages of (set_wise step, row wise steps after it). The first stage has None instead, when the plan doesn't start with a set_wise step.
+    """
+    stages = []
+    for f in plan:
+        if FILTER_SPECS[f].get("set_wise"):
+            stages.append((f, []))
+        elif not stages:
+            stages.append((None, [f]))
+        else:
+            stages[-1][1].append(f)
+    return stages
+
+
+def stream_filters(frames, filters: list, spill_dir: os.PathLike, unit: str = "rows", **kwargs) -> list:
+    """
+    like run_filters, but `frames` yields the data one part at a time. Returns the paths of the spilled parts with the remaining rows (empty parts are dropped).
+    Row wise steps run on one part at a time. A set_wise step loads only the columns it reads (and sort_by) from all parts,
+    the rows it keeps and the columns it adds are then merged back part by part, together with the row wise steps after it.
+    The numbers of remaining rows are summed over the parts and printed at the end.
+    """
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return []
+    stages = plan_stages(plan_filters(filters, first.columns))
+    if not stages or stages[0][0] is not None:
+        stages.insert(0, (None, []))
+    loaded = 0
+    counts = {}
+
+    def report(name, remaining):
+        counts[name] = counts.get(name, 0) + remaining
+
+    def spill(dataframe, stage, part):
+        path = os.path.join(spill_dir, f"{unit}-{stage}-{part:05d}.parquet")
+        spill_frame(dataframe, path)
+        return path
+
+    parts = []
+    for dataframe in itertools.chain([first], frames):
+        loaded += len(dataframe)
+        dataframe = apply_plan(dataframe, stages[0][1], report, **kwargs)
+        if len(dataframe):
+            parts.append(spill(dataframe, 0, len(parts)))
+
+    for stage, (f, row_steps) in enumerate(stages[1:], start=1):
+        if not parts:
+            break
+        columns = list(dict.fromkeys(FILTER_SPECS[f]["reads"] + [kwargs.get("sort_by", "date")]))
+        part_dfs = [read_spill(path, columns=columns) for path in parts]
+        offsets = np.cumsum([0] + [len(part_df) for part_df in part_dfs])
+        kept = apply_plan(pd.concat(part_dfs, ignore_index=True), [f], report, **kwargs).sort_index()
+        del part_dfs
+        positions = kept.index.to_numpy()
+        new_parts = []
+        for part, path in enumerate(parts):
+            start, end = np.searchsorted(positions, offsets[part:part + 2])
+            dataframe = read_spill(path).iloc[positions[start:end] - offsets[part]].reset_index(drop=True)
+            for name in FILTER_SPECS[f].get("adds", []):
+                dataframe[name] = kept[name].to_numpy()[start:end]
+            dataframe = apply_plan(dataframe, row_steps, report, **kwargs)
+            os.remove(path)
+            if len(dataframe):
+                new_parts.append(spill(dataframe, stage, len(new_parts)))
+        parts = new_parts
+
+    print(loaded)
+    for name, remaining in counts.items():
+        print(f"{remaining} {unit} remaining after {name}")
+    return parts
+
+
 # -------------------------
 # DATASET PREPARATION
 # -------------------------
@@ -269,37 +684,75 @@ def prepare_repo_folder(ds: datasets.Dataset, output_dir: os.PathLike) -> None:
 
 
 
-if __name__ == "__main__":
-    args = argument_parser.parse_args()
-
-    if args.filters != "all":
-        raise NotImplementedError("only 'all' filters are implemented yet.")
-
-    loaded_data = load_data(args.input)
-    # TODO combine.. how?
-    print(f"loaded {len(loaded_data)} annotated shader programs")
-
-    filtered_programs = filter_programs(loaded_data)
-    print(f"filtered down to {len(filtered_programs)} shader programs")
+def clean_functions(dataframe: pd.DataFrame, frequencies) -> pd.DataFrame:
+    """
+    adds the frequency columns and drops the ones that are only needed while filtering.
+    """
+    # add extra columns?
+    # TODO: this is missing the "docstring" part.
+    function_frequency, header_frequency = frequencies.lookup(dataframe["image_code"], dataframe["func_bytes"])
+    dataframe["function_frequency"] = function_frequency
+    dataframe["header_frequency"] = header_frequency
+    # the cluster ids are positions within this run, only the sizes mean something in the dataset
+    return dataframe.drop(columns=["docstring", "needed", "cluster_id", "signature"], errors="ignore")
+
+
+def stream_dataset(input_dir: os.PathLike, spill_dir: os.PathLike, program_filters: list, function_filters: list, frequencies_path=None, **kwargs) -> datasets.Dataset:
+    """
+    builds the dataset shard by shard (see stream_filters), so memory doesn't grow with the input. The programs of each shard are filtered and expanded
+    to functions on their own, only the dedup filters and the frequency counts go over everything, with the columns they need.
+    """
+    program_parts = stream_filters(iter_data(input_dir, columns=PROGRAM_COLUMNS), program_filters, spill_dir, unit="shaderprograms", **kwargs)
+    func_frames = (expand_functions(read_spill(path)) for path in program_parts)
+    function_parts = stream_filters(func_frames, function_filters, spill_dir, unit="functions", **kwargs)
+    for path in program_parts:
+        os.remove(path)
+
+    frequencies = count_functions(input_dir, path=frequencies_path)
+    out_paths = []
+    for part, path in enumerate(function_parts):
+        out_path = os.path.join(spill_dir, f"dataset-{part:05d}.parquet")
+        pq.write_table(pa.Table.from_pandas(clean_functions(read_spill(path), frequencies), preserve_index=False), out_path)
+        os.remove(path)
+        out_paths.append(out_path)
+    if not out_paths:
+        return datasets.Dataset.from_dict({}, split="test")
+    # a column can be all null in one part, the unified schema has the actual type
+    schema = pa.unify_schemas([pq.read_schema(path) for path in out_paths]).remove_metadata()
+    return datasets.Dataset.from_parquet(out_paths, split="test", features=datasets.Features.from_arrow_schema(schema))
 
-    all_funcs = expand_functions(loaded_data)
-    func_df = expand_functions(filtered_programs)
-    print(f"expanded to {len(func_df)} functions")
 
-    filtered_funcs = filter_functions(func_df)
-    print(f"filtered down to {len(filtered_funcs)} functions")
+if __name__ == "__main__":
+    args = argument_parser.parse_args()
 
+    program_filters, function_filters = select_filters(args.filters)
 
-    # add extra columns?
-    # TODO: this is missing the "docstring" part.
-    all_funcs["function"] = all_funcs["header"] + all_funcs["body"]
-    filtered_funcs["function"] = filtered_funcs["header"] + filtered_funcs["body"]
-    filtered_funcs["function_frequency"] = all_funcs["function"].value_counts()[filtered_funcs["function"]].values
-    filtered_funcs["header_frequency"] = all_funcs["header"].value_counts()[filtered_funcs["header"]].values
-    clean_func_df = filtered_funcs.drop(columns=["function", "docstring", "needed"])
-    # prepare the Dataset?
-    initial_df = datasets.Dataset.from_pandas(clean_func_df, split="test")
-    clean_df = initial_df.remove_columns(['__index_level_0__'])
-    print(clean_df)
-    print(f"datas set with {len(clean_df)} functions, and columns: {clean_df.column_names}")
-    prepare_repo_folder(clean_df, args.output)
\ No newline at end of file
+    if args.streaming:
+        with tempfile.TemporaryDirectory(dir=args.spill_dir) as spill_dir:
+            clean_df = stream_dataset(args.input, spill_dir, program_filters, function_filters, frequencies_path=args.frequencies, test_workers=args.test_workers)
+            print(f"datas set with {len(clean_df)} functions, and columns: {clean_df.column_names}")
+            prepare_repo_folder(clean_df, args.output)
+    else:
+        loaded_data = load_data(args.input, columns=PROGRAM_COLUMNS)
+        # TODO combine.. how?
+        print(f"loaded {len(loaded_data)} annotated shader programs")
+
+        filtered_programs = filter_programs(loaded_data, filters=program_filters)
+        del loaded_data
+        print(f"filtered down to {len(filtered_programs)} shader programs")
+
+        func_df = expand_functions(filtered_programs)
+        print(f"expanded to {len(func_df)} functions")
+
+        filtered_funcs = filter_functions(func_df, filters=function_filters, test_workers=args.test_workers)
+        del func_df
+        print(f"filtered down to {len(filtered_funcs)} functions")
+
+        # counted over the whole input (header + body), by streaming the shards instead of expanding all of them
+        frequencies = count_functions(args.input, path=args.frequencies)
+        clean_func_df = clean_functions(filtered_funcs, frequencies)
+        # prepare the Dataset?
+        clean_df = datasets.Dataset.from_pandas(clean_func_df, split="test", preserve_index=False)
+        print(clean_df)
+        print(f"datas set with {len(clean_df)} functions, and columns: {clean_df.column_names}")
+        prepare_repo_folder(clean_df, args.output)
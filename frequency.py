@@ -0,0 +1,161 @@
+import hashlib
+import os
+from array import array
+
+import numpy as np
+
+from storage import iter_shard, list_shards, shard_signature
+
+# how often each function (header + body) and each header appears in the corpus, without building a table of all functions.
+# only 64 bit hashes of the byte slices and their counts are kept, and saved to a .npz file to be reused while the shards don't change.
+HASH_VERSION = "1"  # bump when the hashed slices change, stored tables are recomputed then
+PENDING_SIZE = 1 << 20  # keys collected before they are merged into the counts
+
+
+def hash_bytes(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def slice_keys(code_bytes: bytes, func_bytes) -> tuple:
+    """
+    hashes of the header and of header + body (without the docstring) of the function at `func_bytes`
+    """
+    header = code_bytes[func_bytes[1]:func_bytes[2]]
+    return hash_bytes(header), hash_bytes(header + code_bytes[func_bytes[3]:func_bytes[4]])
+
+
+class FrequencyTable:
+    """
+    counts per 64 bit key, as sorted numpy arrays. Added keys are merged in batches, so memory grows with the distinct keys.
+    """
+    def __init__(self, keys: np.ndarray = None, counts: np.ndarray = None):
+        self._keys = np.empty(0, dtype=np.uint64) if keys is None else keys
+        self._counts = np.empty(0, dtype=np.int64) if counts is None else counts
+        self._pending = array("Q")
+
+    def add(self, key: int) -> None:
+        self._pending.append(key)
+        if len(self._pending) >= PENDING_SIZE:
+            self._merge()
+
+    def _merge(self) -> None:
+        if not self._pending:
+            return
+        keys = np.concatenate([self._keys, np.frombuffer(self._pending, dtype=np.uint64)])
+        counts = np.concatenate([self._counts, np.ones(len(self._pending), dtype=np.int64)])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._counts = np.bincount(inverse, weights=counts, minlength=len(self._keys)).astype(np.int64)
+        self._pending = array("Q")
+
+    @property
+    def keys(self) -> np.ndarray:
+        self._merge()
+        return self._keys
+
+    @property
+    def counts(self) -> np.ndarray:
+        self._merge()
+        return self._counts
+
+    def lookup(self, keys) -> np.ndarray:
+        """
+        counts of the keys, 0 for keys that were never added
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        table_keys, counts = self.keys, self.counts
+        if not len(table_keys):
+            return np.zeros(len(keys), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+        return np.where(table_keys[positions] == keys, counts[positions], 0)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class FunctionFrequencies:
+    """
+    function and header counts over a set of shards, `shards` maps each counted shard to its signature.
+    """
+    def __init__(self, functions: FrequencyTable = None, headers: FrequencyTable = None, shards: dict = None):
+        self.functions = FrequencyTable() if functions is None else functions
+        self.headers = FrequencyTable() if headers is None else headers
+        self.shards = {} if shards is None else shards
+
+    def add_program(self, code: str, functions: list) -> None:
+        if not isinstance(functions, list) or not functions:
+            return
+        code_bytes = bytes(code, encoding="utf-8")
+        for func in functions:
+            header_key, function_key = slice_keys(code_bytes, func)
+            self.headers.add(header_key)
+            self.functions.add(function_key)
+
+    def add_shard(self, path) -> None:
+        for record in iter_shard(path, columns=["image_code", "functions"]):
+            self.add_program(record.get("image_code", ""), record.get("functions"))
+        self.shards[path] = shard_signature(path)
+
+    def lookup(self, code_list, func_bytes_list) -> tuple:
+        """
+        function_frequency and header_frequency for every function (image_code and func_bytes, like the rows of expand_functions)
+        """
+        encoded = {}
+        header_keys = []
+        function_keys = []
+        for code, func_bytes in zip(code_list, func_bytes_list):
+            if code not in encoded:
+                encoded[code] = bytes(code, encoding="utf-8")
+            header_key, function_key = slice_keys(encoded[code], func_bytes)
+            header_keys.append(header_key)
+            function_keys.append(function_key)
+        return self.functions.lookup(function_keys), self.headers.lookup(header_keys)
+
+    def save(self, path) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(HASH_VERSION),
+                function_keys=self.functions.keys,
+                function_counts=self.functions.counts,
+                header_keys=self.headers.keys,
+                header_counts=self.headers.counts,
+                shard_paths=np.array(list(self.shards), dtype=str),
+                shard_signatures=np.array(list(self.shards.values()), dtype=str),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> "FunctionFrequencies":
+        """
+        the stored table, or None if there is none (or it was hashed differently)
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as stored:
+            if str(stored["version"]) != HASH_VERSION:
+                return None
+            return cls(
+                FrequencyTable(stored["function_keys"], stored["function_counts"]),
+                FrequencyTable(stored["header_keys"], stored["header_counts"]),
+                dict(zip(stored["shard_paths"].tolist(), stored["shard_signatures"].tolist())),
+            )
+
+
+def count_functions(data_dir, path=None) -> FunctionFrequencies:
+    """
+    counts the functions of all shards in data_dir (and one subdirectory deeper), one record at a time.
+    With `path` the table stored there is reused if it counted exactly the current shards, otherwise it's recomputed and saved.
+    """
+    current = {file: shard_signature(file) for file in list_shards(data_dir)}
+    if path:
+        stored = FunctionFrequencies.load(path)
+        if stored is not None and stored.shards == current:
+            return stored
+    frequencies = FunctionFrequencies()
+    for file in current:
+        frequencies.add_shard(file)
+    if path:
+        frequencies.save(path)
+    return frequencies
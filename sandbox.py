@@ -0,0 +1,204 @@
+import argparse
+import atexit
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+# "wgpu" renders with wgpu-shadertoy, "fake" only pretends to, so the pool can be tested on machines without a GPU
+DEFAULT_BACKEND = os.getenv("SHADER_TEST_BACKEND", "wgpu")
+STARTUP_TIMEOUT = 120  # seconds for a worker to import everything and report ready
+MAX_TASKS = 200  # workers are recycled after this many shaders, in case the renderer leaks
+
+argument_parser = argparse.ArgumentParser(description="long lived worker that tests shaders it receives on stdin")
+argument_parser.add_argument("--backend", type=str, default=DEFAULT_BACKEND, choices=["wgpu", "fake"])
+
+
+# -------------------------
+# WORKER SIDE
+# -------------------------
+# some shader code causes rust panics in wgpu, which take the python process down with them, hence the separate processes.
+# see https://github.com/pygfx/wgpu-py/pull/603, the metric does the same:
+# https://huggingface.co/spaces/Vipitis/shadermatch/blob/c569c78182dc618b36b0883b7d66621481ca2933/shadermatch.py#L302
+def wgpu_backend():
+    from wgpu_shadertoy import Shadertoy
+
+    def render(shader_code):
+        shader = Shadertoy(shader_code, shader_type="glsl", offscreen=True)
+        # dual snapshot is required since first one doesn't crash it seems.
+        shader.snapshot(12.34)
+        shader.snapshot(56.78)
+    return render
+
+
+def fake_backend():
+    def render(shader_code):
+        # markers to simulate the failure modes of the real renderer
+        if "// sandbox:hang" in shader_code:
+            time.sleep(3600)
+        if "// sandbox:panic" in shader_code:
+            os._exit(101)  # like a rust panic, the process is just gone
+        if "mainImage" not in shader_code:
+            raise RuntimeError("no mainImage entry point")
+    return render
+
+
+BACKENDS = {"wgpu": wgpu_backend, "fake": fake_backend}
+
+
+def serve(backend=DEFAULT_BACKEND) -> None:
+    """
+    worker loop: one json request {"code": ...} per line on stdin, one json reply {"status": "ok"|"error"} per line.
+    a shader that crashes the renderer takes the whole process down, the pool notices and replaces it.
+    """
+    # keep a private copy of stdout for the replies, anything the renderer prints ends up on stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    render = BACKENDS[backend]()
+    replies.write(json.dumps({"status": "ready"}) + "\n")
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break  # parent closed the pipe
+        request = json.loads(line)
+        try:
+            render(request["code"])
+            status = "ok"
+        except Exception:
+            status = "error"  # other errors have a .message like wgpu ones.
+        replies.write(json.dumps({"status": status}) + "\n")
+
+
+# -------------------------
+# PARENT SIDE
+# -------------------------
+class SandboxWorker:
+    """
+    Handle to one worker process. Replies are read by a background thread, so waiting for them can time out.
+    """
+    def __init__(self, backend=DEFAULT_BACKEND):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--backend", backend],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+        )
+        self.tasks = 0
+        self.ready = False
+        self.replies = queue.Queue()
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _read_replies(self) -> None:
+        for line in self.proc.stdout:
+            self.replies.put(json.loads(line))
+        self.replies.put(None)  # EOF, the process is gone
+
+    def _wait_ready(self) -> None:
+        try:
+            reply = self.replies.get(timeout=STARTUP_TIMEOUT)
+        except queue.Empty:
+            reply = None
+        if reply is None:
+            self.kill()
+            raise RuntimeError("sandbox worker failed to start, is the renderer backend installed?")
+        self.ready = True
+
+    def run(self, shader_code: str, timeout: float = 10) -> str:
+        """
+        returns "ok", "error", "timeout" or "panic". After a timeout or panic the worker is unusable.
+        """
+        if not self.ready:
+            self._wait_ready()  # startup time doesn't count towards the timeout
+        self.tasks += 1
+        try:
+            self.proc.stdin.write(json.dumps({"code": shader_code}) + "\n")
+            self.proc.stdin.flush()
+        except OSError:
+            return "panic"
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            return "timeout"
+        if reply is None:
+            return "panic"
+        return reply["status"]
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def kill(self) -> None:
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+
+
+class SandboxPool:
+    """
+    Pool of long lived, isolated test workers that import the renderer once and then test many shaders.
+    Thread safe, each call to `run` borrows an idle worker, so `size` shaders can be tested in parallel.
+    Workers that time out, crash or reach `max_tasks` are replaced right away, so the replacement warms up in the background.
+    """
+    def __init__(self, size: int = 1, backend: str = DEFAULT_BACKEND, max_tasks: int = MAX_TASKS):
+        self.size = size
+        self.backend = backend
+        self.max_tasks = max_tasks
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(SandboxWorker(backend))
+
+    def run(self, shader_code: str, timeout: float = 10) -> str:
+        worker = self.idle.get()
+        try:
+            if not worker.alive():
+                worker = SandboxWorker(self.backend)
+            status = worker.run(shader_code, timeout=timeout)
+            if status in ("timeout", "panic") or worker.tasks >= self.max_tasks:
+                worker.kill()
+                worker = SandboxWorker(self.backend)
+        finally:
+            self.idle.put(worker)
+        return status
+
+    def close(self) -> None:
+        for _ in range(self.size):
+            worker = self.idle.get()
+            try:
+                worker.proc.stdin.close()
+            except OSError:
+                pass  # already dead
+            worker.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_pool = None  # shared default pool of this process
+_pool_lock = threading.Lock()  # the test threads of annotate.py can ask for it at the same time
+
+
+def get_pool(size: int = 1, backend: str = DEFAULT_BACKEND) -> SandboxPool:
+    """
+    returns the shared pool, it's created on first use. Changing the size or backend replaces it.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.size != size or _pool.backend != backend:
+            if _pool is not None:
+                _pool.close()
+            else:
+                atexit.register(lambda: _pool.close())
+            _pool = SandboxPool(size=size, backend=backend)
+        return _pool
+
+
+if __name__ == "__main__":
+    args = argument_parser.parse_args()
+    serve(args.backend)
@@ -0,0 +1,487 @@
+import glob
+import json
+import os
+
+import jsonlines
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# shards are either plain .jsonl files, or block compressed .jsonl.zst files.
+# a .jsonl.zst shard is a sequence of independent zstd frames with up to BLOCK_SIZE lines each,
+# so the whole file is still valid for `zstd -d`. A sidecar .idx file maps each id to the frame holding it.
+# annotated shards can also be written as .parquet, with the fixed schema below so columns can be read on their own.
+SHARD_FORMATS = {"jsonl": ".jsonl", "zst": ".jsonl.zst", "parquet": ".parquet"}
+BLOCK_SIZE = 64  # records per zstd frame
+ZSTD_LEVEL = 10
+ROW_GROUP_SIZE = 1024  # records per parquet row group, the unit that filters can skip
+READ_SIZE = 1 << 16  # compressed bytes read at a time
+
+
+def is_shard(file_name) -> bool:
+    # hidden files are temporary shards that are still being written
+    return str(file_name).endswith(tuple(SHARD_FORMATS.values())) and not os.path.basename(file_name).startswith(".")
+
+
+def list_shards(data_dir) -> list:
+    """
+    paths of all shards in data_dir and one subdirectory deeper
+    """
+    top_files = sorted(glob.glob(os.path.join(data_dir, "*")))
+    sub_files = sorted(glob.glob(os.path.join(data_dir, "*", "*")))
+    return [file for file in top_files + sub_files if is_shard(file)]
+
+
+def shard_stem(file_name) -> str:
+    """
+    file name without the shard extension, "2024-07.jsonl.zst" -> "2024-07"
+    """
+    for ext in sorted(SHARD_FORMATS.values(), key=len, reverse=True):
+        if file_name.endswith(ext):
+            return file_name[: -len(ext)]
+    return file_name
+
+
+def shard_name(stem, shard_format="jsonl") -> str:
+    if shard_format not in SHARD_FORMATS:
+        raise ValueError(f"unknown shard format {shard_format}, chose one of {list(SHARD_FORMATS)}")
+    return f"{stem}{SHARD_FORMATS[shard_format]}"
+
+
+def record_id(record: dict) -> str:
+    """
+    works for the raw API format as well as flattened annotations
+    """
+    if "Shader" in record:
+        return record["Shader"]["info"]["id"]
+    return record["id"]
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise ImportError("compressed shards need the `zstandard` package: pip install zstandard")
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("parquet shards need the `pyarrow` package: pip install pyarrow")
+
+
+def _index_path(path) -> str:
+    return path + ".idx"
+
+
+def _read_frame(f, dctx, pending: bytes = b"") -> tuple:
+    """
+    decompresses the zstd frame at the current position of the open file (`pending` are bytes of it that were already read).
+    Returns (decompressed bytes, compressed length, bytes read past the end of the frame). Only reads READ_SIZE bytes at a time.
+    """
+    dobj = dctx.decompressobj()
+    chunks = []
+    length = 0
+    data = pending or f.read(READ_SIZE)
+    while data:
+        chunks.append(dobj.decompress(data))
+        if dobj.eof:
+            unused = dobj.unused_data
+            return b"".join(chunks), length + len(data) - len(unused), unused
+        length += len(data)
+        data = f.read(READ_SIZE)
+    raise ValueError(f"{f.name} ends in the middle of a zstd frame")
+
+
+def iter_frames(path):
+    """
+    yields (frame offset, decompressed bytes) for every zstd frame in a compressed shard.
+    """
+    _require_zstd()
+    dctx = zstandard.ZstdDecompressor()
+    with open(path, "rb") as f:
+        offset = 0
+        pending = b""
+        while True:
+            pending = pending or f.read(READ_SIZE)
+            if not pending:
+                return
+            chunk, length, pending = _read_frame(f, dctx, pending)
+            yield offset, chunk
+            offset += length
+
+
+def iter_shard(path, with_offsets=False, columns: list = None):
+    """
+    yields all records of a shard, in order.
+    with `with_offsets` yields (offset, record), where the offset is the byte offset of the line for .jsonl,
+    the offset of the zstd frame for .jsonl.zst and the row number for .parquet shards.
+    `columns` only reads these columns from .parquet shards, records from other shards always have all their fields.
+    """
+    if path.endswith(SHARD_FORMATS["parquet"]):
+        _require_pyarrow()
+        row_num = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=ROW_GROUP_SIZE, columns=columns):
+            for row in batch.to_pylist():
+                record = decode_record(row)
+                yield (row_num, record) if with_offsets else record
+                row_num += 1
+    elif path.endswith(SHARD_FORMATS["zst"]):
+        for frame_offset, chunk in iter_frames(path):
+            for line in chunk.splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    yield (frame_offset, record) if with_offsets else record
+    elif with_offsets:
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    yield offset, json.loads(line)
+                offset += len(line)
+    else:
+        with jsonlines.open(path) as reader:
+            yield from reader
+
+
+_shard_indexes = {}  # sidecar index path -> (signature, index)
+INDEX_SHARD_LINE = "#shard"  # last line of a sidecar index, with the signature of the shard it was written for
+
+
+def scan_shard_index(path) -> dict:
+    """
+    builds the index of a compressed shard by reading all of its frames, for when the sidecar index doesn't belong to it
+    """
+    frames = [(offset, [record_id(json.loads(line)) for line in chunk.splitlines()]) for offset, chunk in iter_frames(path)]
+    ends = [offset for offset, _ in frames[1:]] + [os.path.getsize(path)]
+    index = {}
+    for (offset, ids), end in zip(frames, ends):
+        for line_num, shader_id in enumerate(ids):
+            index[shader_id] = (offset, end - offset, line_num)
+    return index
+
+
+def load_shard_index(path) -> dict:
+    """
+    loads the sidecar index of a compressed shard as id -> (frame offset, frame length, line in frame).
+    It's only used if it was written for the shard as it is now (replace_shard swaps the shard first, an append can be interrupted),
+    otherwise the shard is read to find the frames. It's kept in memory until the index file or the shard changes.
+    """
+    signature = f"{shard_signature(_index_path(path))};{shard_signature(path)}"
+    cached = _shard_indexes.get(_index_path(path))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    index = {}
+    written_for = None
+    with open(_index_path(path), "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) == 4:
+                index[parts[0]] = (int(parts[1]), int(parts[2]), int(parts[3]))
+            elif len(parts) == 2 and parts[0] == INDEX_SHARD_LINE:
+                written_for = parts[1]
+    if written_for != shard_signature(path):
+        index = scan_shard_index(path)
+    _shard_indexes[_index_path(path)] = (signature, index)
+    return index
+
+
+def read_record(path, shader_id, offset: int = None) -> dict:
+    """
+    Random access to a single record, without parsing (or decompressing) the rest of the shard.
+    For .jsonl shards the byte `offset` is required. For compressed shards it's the frame offset (like in the shader index),
+    without it the frame is looked up in the sidecar index.
+    For .parquet shards the offset is the row number, or the id is looked up in the id column.
+    """
+    if path.endswith(SHARD_FORMATS["parquet"]):
+        _require_pyarrow()
+        if offset is None:
+            table = pq.read_table(path, filters=[("id", "=", shader_id)])
+            return decode_record(table.to_pylist()[0])
+        parquet_file = pq.ParquetFile(path)
+        for group in range(parquet_file.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(group).num_rows
+            if offset < group_rows:
+                return decode_record(parquet_file.read_row_group(group).slice(offset, 1).to_pylist()[0])
+            offset -= group_rows
+        raise KeyError(f"{shader_id} not found in {path}")
+    if path.endswith(SHARD_FORMATS["zst"]):
+        _require_zstd()
+        if offset is not None:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk, _, _ = _read_frame(f, zstandard.ZstdDecompressor())
+            key = json.dumps(shader_id).encode("utf-8")
+            for line in chunk.splitlines():
+                if key in line:
+                    record = json.loads(line)
+                    if record_id(record) == shader_id:
+                        return record
+            raise KeyError(f"{shader_id} not found in the frame at {offset} of {path}")
+        frame_offset, frame_length, line_num = load_shard_index(path)[shader_id]
+        with open(path, "rb") as f:
+            f.seek(frame_offset)
+            frame = f.read(frame_length)
+        lines = zstandard.ZstdDecompressor().decompress(frame).splitlines()
+        return json.loads(lines[line_num])
+    if offset is None:
+        raise ValueError(f"reading {shader_id} from {path} needs a byte offset")
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+
+# the API (and download.py) use numbers, the website and shaders20k use names
+PUBLISHED_NAMES = {0: "Private", 1: "Public", 2: "Unlisted", 3: "Public API", 4: "Anonymous"}
+PASS_NAMES = ["image", "common", "sound", "buffer_a", "buffer_b", "buffer_c", "buffer_d", "cube_a"]
+# nested values without a fixed structure are stored as json strings
+JSON_COLUMNS = [f"{name}_inputs" for name in PASS_NAMES if name != "common"] + ["stamps"]
+
+
+def annotated_schema():
+    """
+    arrow schema of annotated shards, every column is nullable so records don't need all annotation columns.
+    """
+    _require_pyarrow()
+    fields = [
+        ("id", pa.string()),
+        ("name", pa.string()),
+        ("author", pa.string()),
+        ("description", pa.string()),
+        ("tags", pa.list_(pa.string())),
+        ("likes", pa.int64()),
+        ("viewed", pa.int64()),
+        ("published", pa.string()),
+        ("date", pa.string()),
+        ("time_retrieved", pa.string()),
+    ]
+    for name in PASS_NAMES:
+        fields.append((f"{name}_code", pa.string()))
+        if name != "common":
+            fields.append((f"{name}_inputs", pa.string()))
+    fields += [
+        ("thumbnail", pa.string()),
+        ("access", pa.string()),
+        ("license", pa.string()),
+        ("functions", pa.list_(pa.list_(pa.int64()))),
+        ("test", pa.string()),
+        ("fingerprint", pa.string()),
+        ("stamps", pa.string()),
+    ]
+    return pa.schema(fields)
+
+
+def records_to_table(records: list):
+    """
+    converts annotated records to an arrow table with the `annotated_schema`.
+    `published` is normalized to its name and the JSON_COLUMNS are serialized.
+    """
+    schema = annotated_schema()
+    unknown = {key for record in records for key in record} - set(schema.names)
+    if unknown:
+        raise ValueError(f"columns {sorted(unknown)} are not in the annotated schema, add them to `annotated_schema`")
+    columns = {name: [record.get(name) for record in records] for name in schema.names}
+    columns["published"] = [PUBLISHED_NAMES.get(value, str(value)) if isinstance(value, int) else value for value in columns["published"]]
+    for name in JSON_COLUMNS:
+        columns[name] = [None if value is None else json.dumps(value, ensure_ascii=False) for value in columns[name]]
+    return pa.table(columns, schema=schema)
+
+
+def decode_record(row: dict) -> dict:
+    """
+    inverse of the serialization in `records_to_table`, for a row read from a parquet shard.
+    missing columns come back as nulls, they are left out like in the original record.
+    """
+    for name in JSON_COLUMNS:
+        if row.get(name) is not None:
+            row[name] = json.loads(row[name])
+    return {key: value for key, value in row.items() if value is not None}
+
+
+class ShardWriter:
+    """
+    Writes records to a shard in any of the SHARD_FORMATS, picked by the file extension. mode is "w" or "a".
+    .parquet shards only hold annotated records and can't be appended to.
+    Keeps the offset of every written record in `offsets` (id -> offset), see `iter_shard` for what the offset means.
+    """
+    def __init__(self, path, mode="w"):
+        if mode not in ("w", "a"):
+            raise ValueError(f"unsupported mode {mode}")
+        self.path = path
+        self.compressed = path.endswith(SHARD_FORMATS["zst"])
+        self.columnar = path.endswith(SHARD_FORMATS["parquet"])
+        self.offsets = {}
+        if self.columnar:
+            _require_pyarrow()
+            if mode == "a":
+                raise ValueError("parquet shards can't be appended to, rewrite them with `replace_shard`")
+            self._parquet_writer = pq.ParquetWriter(path, annotated_schema(), compression="zstd")
+            self._rows = []  # records waiting for the next row group
+            self._row_count = 0
+            return
+        self._file = open(path, mode + "b")
+        if self.compressed:
+            _require_zstd()
+            self._cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self._index_file = open(_index_path(path), mode, encoding="utf-8")
+            self._block = []  # (id, line) waiting for the next frame
+        else:
+            self._writer = jsonlines.Writer(self._file)
+
+    def write(self, record: dict) -> None:
+        if self.columnar:
+            self.offsets[record_id(record)] = self._row_count + len(self._rows)
+            self._rows.append(record)
+            if len(self._rows) >= ROW_GROUP_SIZE:
+                self._flush_rows()
+        elif self.compressed:
+            line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+            self._block.append((record_id(record), line))
+            if len(self._block) >= BLOCK_SIZE:
+                self._flush_block()
+        else:
+            self.offsets[record_id(record)] = self._file.tell()
+            self._writer.write(record)
+
+    def write_all(self, records) -> None:
+        for record in records:
+            self.write(record)
+
+    def _flush_block(self) -> None:
+        if not self._block:
+            return
+        frame_offset = self._file.tell()
+        frame = self._cctx.compress(b"".join(line for _, line in self._block))
+        self._file.write(frame)
+        for line_num, (shader_id, _) in enumerate(self._block):
+            self.offsets[shader_id] = frame_offset
+            self._index_file.write(f"{shader_id}\t{frame_offset}\t{len(frame)}\t{line_num}\n")
+        self._block = []
+
+    def _flush_rows(self) -> None:
+        if not self._rows:
+            return
+        self._parquet_writer.write_table(records_to_table(self._rows), row_group_size=ROW_GROUP_SIZE)
+        self._row_count += len(self._rows)
+        self._rows = []
+
+    def close(self) -> None:
+        if self.columnar:
+            self._flush_rows()
+            self._parquet_writer.close()
+            return
+        if self.compressed:
+            self._flush_block()
+        self._file.close()
+        if self.compressed:
+            # after the shard is complete, so readers can tell if the index belongs to it (see load_shard_index)
+            self._index_file.write(f"{INDEX_SHARD_LINE}\t{shard_signature(self.path)}\n")
+            self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replace_shard(path, records) -> dict:
+    """
+    Writes records to a temporary file next to `path` and then swaps it into place, followed by the sidecar index.
+    So readers never see a half written shard, and an index that doesn't match the shard yet isn't used (see load_shard_index). `records` may be a generator reading from `path` itself.
+    Returns the offsets of the written records.
+    """
+    # keep the shard extension on the temp file, so the writer picks the same format
+    head, tail = os.path.split(path)
+    tmp_path = os.path.join(head, f".tmp_{tail}")
+    with ShardWriter(tmp_path, mode="w") as writer:
+        writer.write_all(records)
+    os.replace(tmp_path, path)
+    if writer.compressed:
+        os.replace(_index_path(tmp_path), _index_path(path))
+    return writer.offsets
+
+
+def remove_shard(path) -> None:
+    """
+    deletes a shard together with its sidecar index and takes it out of the id index of its directory
+    """
+    os.remove(path)
+    if os.path.exists(_index_path(path)):
+        os.remove(_index_path(path))
+    directory, file_name = os.path.split(path)
+    entries = _read_id_index(directory)
+    if entries.pop(file_name, None) is not None:
+        _write_id_index(directory, entries)
+
+
+# id -> shard lookup for a whole directory, kept in a sidecar file with one line per shard: file, signature, ids
+ID_INDEX_FILE = "id_index.tsv"
+
+
+def shard_signature(path) -> str:
+    """
+    changes whenever the shard is rewritten (mtime and size)
+    """
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _read_id_index(directory) -> dict:
+    entries = {}
+    index_path = os.path.join(directory, ID_INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) == 3:
+                    entries[parts[0]] = (parts[1], parts[2].split(",") if parts[2] else [])
+    return entries
+
+
+def _write_id_index(directory, entries: dict) -> None:
+    index_path = os.path.join(directory, ID_INDEX_FILE)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for file_name, (signature, ids) in sorted(entries.items()):
+            f.write(f"{file_name}\t{signature}\t{','.join(ids)}\n")
+    os.replace(tmp_path, index_path)
+
+
+def load_id_index(directory) -> dict:
+    """
+    Returns id -> list of shard files (in `directory`) that contain it.
+    Only shards that were changed since the index was last saved (by mtime and size) are read again.
+    """
+    stored = _read_id_index(directory)
+    current = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not is_shard(file_name):
+            continue
+        path = os.path.join(directory, file_name)
+        signature = shard_signature(path)
+        if file_name in stored and stored[file_name][0] == signature:
+            current[file_name] = stored[file_name]
+        else:
+            current[file_name] = (signature, [record_id(record) for record in iter_shard(path)])
+    if current != stored:
+        _write_id_index(directory, current)
+    id_index = {}
+    for file_name, (_, ids) in current.items():
+        for shader_id in ids:
+            id_index.setdefault(shader_id, []).append(file_name)
+    return id_index
+
+
+def set_shard_ids(directory, file_name, ids: list) -> None:
+    """
+    records the ids of a shard that was just written, so it doesn't need to be read again by `load_id_index`
+    """
+    entries = _read_id_index(directory)
+    entries[file_name] = (shard_signature(os.path.join(directory, file_name)), list(ids))
+    _write_id_index(directory, entries)
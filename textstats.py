@@ -0,0 +1,72 @@
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# text statistics over whole columns at once, computed by arrow kernels instead of python per row.
+# all functions take a pandas Series of strings (missing values count as "") and return a Series with the same index.
+
+
+def to_arrow(series: pd.Series) -> pa.Array:
+    return pc.fill_null(pa.array(series, type=pa.large_string(), from_pandas=True), "")
+
+
+def char_length(series: pd.Series) -> pd.Series:
+    """
+    number of characters (code points), like `len`
+    """
+    return pd.Series(pc.utf8_length(to_arrow(series)).to_numpy(), index=series.index)
+
+
+def byte_length(series: pd.Series) -> pd.Series:
+    """
+    length of the utf-8 encoding, the unit of the byte-indices in the functions column
+    """
+    return pd.Series(pc.binary_length(to_arrow(series)).to_numpy(), index=series.index)
+
+
+def alphabetic_ratio(series: pd.Series) -> pd.Series:
+    """
+    share of letters among all characters, the same letters as `str.isalpha`. NaN for empty strings.
+    """
+    arr = to_arrow(series)
+    # dropping every run of non letters is quicker than counting the letters one match at a time
+    letters = pc.utf8_length(pc.replace_substring_regex(arr, r"[^A-Za-z]+", "")).to_numpy().copy()
+    # the few strings with non ascii characters are counted in python, the unicode letter class is slow to compile in arrow
+    non_ascii = pc.indices_nonzero(pc.invert(pc.string_is_ascii(arr))).to_numpy()
+    for idx, text in zip(non_ascii, arr.take(non_ascii).to_pylist()):
+        letters[idx] = sum(c.isalpha() for c in text)
+    chars = pc.utf8_length(arr).to_numpy().astype("float64")
+    chars[chars == 0] = float("nan")
+    return pd.Series(letters / chars, index=series.index)
+
+
+def keyword_pattern(words: list) -> str:
+    """
+    a single regex matching any of the words literally
+    """
+    return "|".join(re.escape(word) for word in words)
+
+
+def contains_keywords(series: pd.Series, words: list, case=False) -> pd.Series:
+    """
+    True where any of the words appear, with one pass over the column for all words together
+    """
+    if not words:
+        return pd.Series(False, index=series.index)
+    matches = pc.match_substring_regex(to_arrow(series), keyword_pattern(words), ignore_case=not case)
+    return pd.Series(matches.to_numpy(zero_copy_only=False), index=series.index)
+
+
+def shader_text(dataframe: pd.DataFrame) -> pd.Series:
+    """
+    name, description and tags of every shader as one string, to search them all at once
+    """
+    parts = [to_arrow(dataframe["name"]), to_arrow(dataframe["description"])]
+    if "tags" in dataframe.columns:
+        tags = pa.array(dataframe["tags"].map(lambda tags: tags if isinstance(tags, list) else []), type=pa.list_(pa.large_string()))
+        parts.append(pc.binary_join(tags, pa.scalar(" ", type=pa.large_string())))
+    text = pc.binary_join_element_wise(*parts, pa.scalar("\n", type=pa.large_string())).to_pandas()
+    text.index = dataframe.index
+    return text